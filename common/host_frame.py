@@ -0,0 +1,139 @@
+# Columnar (pandas) form of the pages of the hosts endpoint, used by get_datadog_hosts and fqdn_duplicates
+
+import re
+
+import pandas as pd
+
+import host_inventory
+
+try:
+    # Optional, only required to write Parquet files
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Columns read as is from a field of the hosts
+HOST_FIELDS = {
+    "host_name": "host_name",
+    "host_aliases": "aliases",
+    "host_apps": "apps",
+    "sources": "sources",
+    "last_reported_time": "last_reported_time",
+    "host_status": "up",
+    "tags": "tags_by_source",
+    "muted": "is_muted"
+}
+
+# Columns of a frame, in the order of the CSV export
+FRAME_COLUMNS = ["host_name", "host_aliases", "os_info", "build_info", "host_apps", "sources", "last_reported_time",
+                 "host_status", "tags", "ipaddress", "muted"]
+
+# IP address at the top level of the network section of a gohai payload, allowing one level of nested objects before
+# it (the network interfaces). Payloads it doesn't match are decoded with host_inventory.gohai_field instead.
+_GOHAI_IPADDRESS_PATTERN = re.compile(r'"network"\s*:\s*\{(?:[^{}]|\{[^{}]*\})*?"ipaddress"\s*:\s*"([^"]*)"')
+
+
+def _field(hosts, field):
+    if field in hosts:
+        return hosts[field]
+
+    return pd.Series(None, index=hosts.index, dtype=object)
+
+
+def _os_version(meta):
+    # Same as get_os_info of list_datadog_hosts: the Windows version, else the macOS version
+    windows_version = meta.str.get("winV")
+
+    return windows_version.where(windows_version.str.len() > 0, meta.str.get("macV"))
+
+
+def _ipaddress(meta):
+    gohai = meta.str.get("gohai")
+    ipaddress = gohai.str.extract(_GOHAI_IPADDRESS_PATTERN, expand=False)
+
+    unmatched = ipaddress.isna() & (gohai.str.len() > 0)
+    if unmatched.any():
+        ipaddress[unmatched] = meta[unmatched].map(
+            lambda host_meta: host_inventory.gohai_field(host_meta, "network", "ipaddress"))
+
+    return ipaddress.fillna("")
+
+
+def page_frame(page, columns=FRAME_COLUMNS):
+    """Builds the columns of one page of hosts returned by the API
+
+    Each column is computed for the whole page at once instead of host by host. Fields missing from a host are null.
+
+    :param dict page: page response of the hosts endpoint
+    :param columns: columns of the frame, among FRAME_COLUMNS
+    :returns: pandas.DataFrame with one row per host
+    """
+    hosts = pd.DataFrame.from_records(page.get("host_list", []))
+    meta = _field(hosts, "meta")
+
+    os_version = _os_version(meta) if {"os_info", "build_info"}.intersection(columns) else None
+
+    frame = {}
+    for column in columns:
+        if column in HOST_FIELDS:
+            frame[column] = _field(hosts, HOST_FIELDS[column])
+        elif column == "os_info":
+            frame[column] = os_version.str.get(0).fillna("N/A")
+        elif column == "build_info":
+            frame[column] = os_version.str.get(1).fillna("N/A")
+        elif column == "ipaddress":
+            frame[column] = _ipaddress(meta)
+        else:
+            raise Exception("Unknown host column {}.".format(column))
+
+    return pd.DataFrame(frame, index=hosts.index)
+
+
+def parquet_schema(columns=FRAME_COLUMNS):
+    """Arrow schema of the columns of a frame, the same for every page so they can be written to one file"""
+    string_list = pa.list_(pa.string())
+    types = {
+        "host_name": pa.string(),
+        "host_aliases": string_list,
+        "os_info": pa.string(),
+        "build_info": pa.string(),
+        "host_apps": string_list,
+        "sources": string_list,
+        "last_reported_time": pa.int64(),
+        "host_status": pa.bool_(),
+        "tags": pa.map_(pa.string(), string_list),
+        "ipaddress": pa.string(),
+        "muted": pa.bool_()
+    }
+
+    return pa.schema([(column, types[column]) for column in columns])
+
+
+class ParquetHostWriter:
+    """Writes page frames to a Parquet file, one row group per page"""
+
+    def __init__(self, path, columns=FRAME_COLUMNS):
+        """
+        :param string path: path of the Parquet file
+        :param columns: columns of the frames written, see FRAME_COLUMNS
+        """
+        if pq is None:
+            raise Exception("pyarrow is required to write Parquet files. Please install it with pip install pyarrow "
+                            "and run again.")
+
+        self.schema = parquet_schema(columns)
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write_frame(self, frame):
+        self.writer.write_table(pa.Table.from_pandas(frame, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
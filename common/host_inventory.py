@@ -0,0 +1,177 @@
+# Shared client for the Datadog hosts endpoint, used by get_datadog_hosts and fqdn_duplicates
+
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import work_pool
+
+DEFAULT_SITE = "api.datadoghq.com"
+
+# Largest page the hosts endpoint returns
+PAGE_SIZE = 1000
+
+# Number of pages requested at the same time
+DEFAULT_WORKERS = 8
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_TIMEOUT = 60
+
+_JSON_DECODER = json.JSONDecoder()
+_GOHAI_SECTION_PATTERNS = {}
+
+
+class HostInventory:
+    """Pages through the Datadog hosts endpoint
+
+    The first page tells how many hosts match, the remaining pages are then requested in parallel over a pooled
+    session that retries rate limited (429) and 5xx responses. Hosts are still yielded in the order of the API.
+    """
+
+    def __init__(self, api_key, app_key, site=DEFAULT_SITE, workers=DEFAULT_WORKERS, page_size=PAGE_SIZE,
+                 max_retries=DEFAULT_MAX_RETRIES, timeout=DEFAULT_TIMEOUT):
+        """
+        :param string api_key: Datadog API key
+        :param string app_key: Datadog application key
+        :param string site: API host of the Datadog site (e.g. api.datadoghq.eu)
+        :param int workers: number of pages requested at the same time
+        :param int page_size: number of hosts per page (at most 1000)
+        :param int max_retries: retries of a page answered with a 429 or 5xx
+        :param int timeout: seconds before a page request times out
+        """
+        self.url = f"https://{site}/api/v1/hosts"
+        self.workers = workers
+        self.page_size = page_size
+        self.timeout = timeout
+
+        retry = Retry(total=max_retries, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "DD-API-KEY": api_key,
+            "DD-APPLICATION-KEY": app_key
+        })
+
+    def get_page(self, filters=None, start=0, include_hosts_metadata=True, include_muted_hosts_data=False,
+                 from_time=None):
+        """Requests a single page of hosts
+
+        :param string filters: optional host search (e.g. field:apps:agent)
+        :param int start: offset of the first host of the page
+        :param boolean include_hosts_metadata: include the 'meta' of each host (gohai, OS versions...), by far the
+                                               largest part of a host
+        :param boolean include_muted_hosts_data: include whether each host is muted and until when
+        :param int from_time: only hosts that reported since this UNIX time (every host if None)
+        :returns: JSON response of the page
+        """
+        params = {
+            "filter": filters,
+            "start": start,
+            "count": self.page_size,
+            "include_hosts_metadata": str(include_hosts_metadata).lower(),
+            "include_muted_hosts_data": str(include_muted_hosts_data).lower(),
+            "from": from_time
+        }
+
+        try:
+            response = self.session.get(self.url, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            raise Exception("Error when getting hosts from api: {}".format(e))
+
+    def iter_pages(self, filters=None, include_hosts_metadata=True, include_muted_hosts_data=False, from_time=None,
+                   allow_empty=False):
+        """Yields every page of hosts matching the search, in order
+
+        Only a bounded number of pages is requested ahead of the one being consumed, so memory stays flat however
+        many hosts match.
+
+        :param string filters: optional host search
+        :param boolean include_hosts_metadata: include the 'meta' of each host, see get_page
+        :param boolean include_muted_hosts_data: include the mute status of each host, see get_page
+        :param int from_time: only hosts that reported since this UNIX time (every host if None)
+        :param boolean allow_empty: yield the single empty page when no host matches instead of raising
+        :returns: generator of page responses, the first one holding the 'total_matching' count
+        """
+        page_options = (include_hosts_metadata, include_muted_hosts_data, from_time)
+        first_page = self.get_page(filters, 0, *page_options)
+        host_count = first_page.get("total_matching")
+
+        if not host_count and not allow_empty:
+            raise Exception("No hosts returned with the query. Please validate that your API/APP key are correct and "
+                            "the query returns hosts via the UI.")
+
+        yield first_page
+
+        starts = range(self.page_size, host_count or 0, self.page_size)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pages = work_pool.iter_bounded(executor, starts, lambda start: self.get_page(filters, start, *page_options),
+                                           self.workers * 2, ordered=True)
+
+            for _, page, error in pages:
+                if error is not None:
+                    raise error
+
+                yield page
+
+    def iter_hosts(self, filters=None, include_hosts_metadata=True, include_muted_hosts_data=False, from_time=None):
+        """Yields every host matching the search, in order
+
+        :param string filters: optional host search
+        :param boolean include_hosts_metadata: include the 'meta' of each host, see get_page
+        :param boolean include_muted_hosts_data: include the mute status of each host, see get_page
+        :param int from_time: only hosts that reported since this UNIX time (every host if None)
+        :returns: generator of hosts as returned in the 'host_list' of each page
+        """
+        for page in self.iter_pages(filters, include_hosts_metadata, include_muted_hosts_data, from_time):
+            yield from page.get("host_list", [])
+
+
+def gohai_section(gohai, section):
+    """Decodes a single top-level section of the gohai payload of a host
+
+    The gohai payload is a JSON string of several KB (cpu, filesystem, memory, network, platform). Only the requested
+    section is decoded, the rest of the payload is skipped over.
+
+    :param string gohai: the 'gohai' string of the host metadata
+    :param string section: name of the section (e.g. network)
+    :returns: the section, or an empty dict if the host has none
+    """
+    if not gohai:
+        return {}
+
+    pattern = _GOHAI_SECTION_PATTERNS.get(section)
+    if pattern is None:
+        pattern = _GOHAI_SECTION_PATTERNS[section] = re.compile(r'"{}"\s*:\s*(?=\{{)'.format(re.escape(section)))
+
+    match = pattern.search(gohai)
+    if match is None:
+        return {}
+
+    try:
+        value, _ = _JSON_DECODER.raw_decode(gohai, match.end())
+    except ValueError:
+        # Not where it was expected (e.g. the name is also used deeper in the payload), decode everything instead
+        return json.loads(gohai).get(section) or {}
+
+    return value
+
+
+def gohai_field(meta, section, field, default=""):
+    """Reads one field of a gohai section from the metadata of a host, e.g. gohai_field(meta, "network", "ipaddress")
+
+    :param dict meta: the 'meta' of the host
+    :param string section: name of the gohai section
+    :param string field: name of the field in the section
+    :param default: value returned when the host doesn't have the field
+    :returns: value of the field
+    """
+    return gohai_section(meta.get("gohai", ""), section).get(field, default)
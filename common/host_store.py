@@ -0,0 +1,201 @@
+# Local SQLite inventory of Datadog hosts, refreshed incrementally from the hosts endpoint
+
+import hashlib
+import json
+import sqlite3
+import time
+
+# Hosts that have not reported for this long are considered removed by an incremental refresh
+DEFAULT_STALE_HOURS = 24
+
+# Each incremental refresh asks for hosts reported a little before the previous refresh started, so hosts reporting
+# while it was running are not missed
+REFRESH_OVERLAP_SECONDS = 300
+
+# Number of hosts written per statement
+WRITE_BATCH_SIZE = 1000
+
+# Kinds of change in a delta export
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS refreshes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at INTEGER NOT NULL,
+    filters TEXT,
+    from_time INTEGER,
+    host_count INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS hosts (
+    host_name TEXT PRIMARY KEY,
+    last_reported_time INTEGER,
+    tags TEXT,
+    aliases TEXT,
+    sources TEXT,
+    fingerprint TEXT,
+    added_refresh INTEGER,
+    changed_refresh INTEGER,
+    seen_refresh INTEGER,
+    removed_refresh INTEGER
+);
+"""
+
+# A host coming back after being removed counts as added again, a host only counts as changed when its tags,
+# aliases or sources change (its last_reported_time changes on every refresh)
+UPSERT_HOST = """
+INSERT INTO hosts (host_name, last_reported_time, tags, aliases, sources, fingerprint, added_refresh,
+                   changed_refresh, seen_refresh, removed_refresh)
+VALUES (:host_name, :last_reported_time, :tags, :aliases, :sources, :fingerprint, :refresh, :refresh, :refresh, NULL)
+ON CONFLICT (host_name) DO UPDATE SET
+    last_reported_time = excluded.last_reported_time,
+    tags = excluded.tags,
+    aliases = excluded.aliases,
+    sources = excluded.sources,
+    fingerprint = excluded.fingerprint,
+    added_refresh = CASE WHEN hosts.removed_refresh IS NOT NULL THEN excluded.added_refresh
+                         ELSE hosts.added_refresh END,
+    changed_refresh = CASE WHEN hosts.fingerprint != excluded.fingerprint THEN excluded.changed_refresh
+                           ELSE hosts.changed_refresh END,
+    seen_refresh = excluded.seen_refresh,
+    removed_refresh = NULL
+"""
+
+
+def host_row(host, refresh_id):
+    """Builds the stored row of a host returned by the API
+
+    :param dict host: host from the 'host_list' of a page
+    :param int refresh_id: id of the refresh the host was read by
+    :returns: dict of the columns of the host
+    """
+    tags = {source: sorted(source_tags) for source, source_tags in (host.get("tags_by_source") or {}).items()}
+    aliases = sorted(host.get("aliases") or [])
+    sources = sorted(host.get("sources") or [])
+
+    row = {
+        "host_name": host.get("host_name", ""),
+        "last_reported_time": host.get("last_reported_time"),
+        "tags": json.dumps(tags, sort_keys=True),
+        "aliases": json.dumps(aliases),
+        "sources": json.dumps(sources),
+        "refresh": refresh_id
+    }
+    row["fingerprint"] = hashlib.sha1("\n".join((row["tags"], row["aliases"], row["sources"])).encode("utf-8")) \
+        .hexdigest()[:16]
+
+    return row
+
+
+class HostStore:
+    """SQLite inventory of the hosts matching a search, keyed by host name
+
+    The first refresh reads every host. The following ones only ask the API for the hosts that reported since the
+    previous refresh (the 'from' parameter of the hosts endpoint) and without host metadata, which is a fraction of the
+    calls and data of a full read. Each refresh is numbered so the hosts added, removed or changed by a refresh can be
+    exported as a delta.
+    """
+
+    def __init__(self, path):
+        """
+        :param string path: path of the SQLite file (created if it doesn't exist)
+        """
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def last_refresh(self):
+        """Latest refresh of the store
+
+        :returns: dict with the 'id', 'started_at', 'filters', 'from_time' and 'host_count' of the refresh, or None
+        """
+        row = self.connection.execute("SELECT * FROM refreshes ORDER BY id DESC LIMIT 1").fetchone()
+        return dict(row) if row else None
+
+    def refresh(self, inventory, filters=None, full=False, stale_hours=DEFAULT_STALE_HOURS):
+        """Brings the store up to date with the API
+
+        A full refresh marks every stored host it didn't read as removed. An incremental refresh marks as removed the
+        hosts that haven't reported for stale_hours.
+
+        :param host_inventory.HostInventory inventory: client used to read the hosts
+        :param string filters: optional host search, must be the same for every refresh of a store
+        :param boolean full: read every host even if the store was already refreshed
+        :param float stale_hours: hours without reporting after which an incremental refresh removes a host
+        :returns: dict of the refresh (see last_refresh)
+        """
+        previous = self.last_refresh()
+
+        if previous and previous["filters"] != filters:
+            raise Exception("The host store was built for the search {}. Please use the same search or another store "
+                            "file and run again.".format(previous["filters"] or "<all hosts>"))
+
+        started_at = int(time.time())
+        from_time = None if full or previous is None else previous["started_at"] - REFRESH_OVERLAP_SECONDS
+
+        with self.connection:
+            refresh_id = self.connection.execute(
+                "INSERT INTO refreshes (started_at, filters, from_time) VALUES (?, ?, ?)",
+                (started_at, filters, from_time)
+            ).lastrowid
+
+            host_count = 0
+            for page in inventory.iter_pages(filters, include_hosts_metadata=False, from_time=from_time,
+                                             allow_empty=from_time is not None):
+                rows = [host_row(host, refresh_id) for host in page.get("host_list", [])]
+
+                for index in range(0, len(rows), WRITE_BATCH_SIZE):
+                    self.connection.executemany(UPSERT_HOST, rows[index:index + WRITE_BATCH_SIZE])
+
+                host_count += len(rows)
+
+            if from_time is None:
+                self.connection.execute(
+                    "UPDATE hosts SET removed_refresh = ? WHERE seen_refresh != ? AND removed_refresh IS NULL",
+                    (refresh_id, refresh_id)
+                )
+            else:
+                self.connection.execute(
+                    "UPDATE hosts SET removed_refresh = ? WHERE last_reported_time < ? AND removed_refresh IS NULL",
+                    (refresh_id, started_at - stale_hours * 3600)
+                )
+
+            self.connection.execute("UPDATE refreshes SET host_count = ? WHERE id = ?", (host_count, refresh_id))
+
+        return self.last_refresh()
+
+    def iter_delta(self, since_refresh=None):
+        """Yields the hosts added, removed or changed after a refresh
+
+        :param int since_refresh: id of the refresh the delta starts after (defaults to the one before the latest
+                                  refresh, i.e. what the latest refresh changed)
+        :returns: generator of tuples of the change (ADDED/REMOVED/CHANGED) and the stored host (dict)
+        """
+        if since_refresh is None:
+            last = self.last_refresh()
+            since_refresh = last["id"] - 1 if last else 0
+
+        # A host both added and removed after the refresh never existed as far as the delta is concerned
+        queries = (
+            (ADDED, "added_refresh > :since AND removed_refresh IS NULL"),
+            (REMOVED, "removed_refresh > :since AND added_refresh <= :since"),
+            (CHANGED, "changed_refresh > :since AND added_refresh <= :since AND removed_refresh IS NULL")
+        )
+
+        for change, condition in queries:
+            cursor = self.connection.execute(
+                "SELECT * FROM hosts WHERE {} ORDER BY host_name".format(condition), {"since": since_refresh}
+            )
+
+            for row in cursor:
+                yield change, dict(row)
+
+    def iter_hosts(self):
+        """Yields every host of the store that is not removed, by name"""
+        for row in self.connection.execute("SELECT * FROM hosts WHERE removed_refresh IS NULL ORDER BY host_name"):
+            yield dict(row)
@@ -0,0 +1,80 @@
+# Bounded window of work shared by the host scripts and the tag replacer
+
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+def _outcome(pending, future):
+    item = pending.pop(future)
+    error = future.exception()
+
+    return item, None if error else future.result(), error
+
+
+def iter_bounded(executor, items, function, max_pending, ordered=False):
+    """Calls function on every item in an executor, with at most max_pending items submitted and not yet yielded
+
+    Items are only read from the iterable when there is room in the window, so a long or lazily built list is never
+    queued all at once and every outcome is handed back while the rest are still running.
+
+    :param concurrent.futures.Executor executor: executor running the calls
+    :param items: iterable of the items to process
+    :param function: called with each item
+    :param int max_pending: max number of items submitted and not yet yielded
+    :param boolean ordered: yield the outcomes in the order of the items instead of as soon as each one is done
+    :returns: generator of (item, result, error) tuples, where error is the exception raised by function or None
+    """
+    # Dicts keep their insertion order, so the first key is always the oldest item submitted
+    pending = {}
+
+    def done_outcomes():
+        if ordered:
+            return [_outcome(pending, next(iter(pending)))]
+
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        return [_outcome(pending, future) for future in done]
+
+    for item in items:
+        if len(pending) >= max_pending:
+            yield from done_outcomes()
+
+        pending[executor.submit(function, item)] = item
+
+    while pending:
+        yield from done_outcomes()
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+async def iter_bounded_async(items, function, max_pending):
+    """asyncio counterpart of iter_bounded, yields the outcomes as soon as each item is done
+
+    :param items: iterable or async iterable of the items to process
+    :param function: coroutine function called with each item
+    :param int max_pending: max number of items in flight and not yet yielded
+    :returns: async generator of (item, result, error) tuples, where error is the exception raised or None
+    """
+    pending = {}
+
+    async def done_outcomes():
+        done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+        return [_outcome(pending, task) for task in done]
+
+    try:
+        async for item in items if hasattr(items, "__aiter__") else _aiter(items):
+            if len(pending) >= max_pending:
+                for outcome in await done_outcomes():
+                    yield outcome
+
+            pending[asyncio.ensure_future(function(item))] = item
+
+        while pending:
+            for outcome in await done_outcomes():
+                yield outcome
+    finally:
+        # The consumer stopped early, don't leave the remaining items running
+        for task in pending:
+            task.cancel()
@@ -1,130 +1,182 @@
 #!/usr/bin/env python3
 # Script to pull all hosts from Datadog API and creates a csv file with the hosts and their tags
 
-import requests, sys, json, datetime, csv
+import sys, os, datetime, csv, gzip, argparse, itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import host_inventory
+import host_store
+
+try:
+    # Optional, only required to write Parquet files
+    import host_frame
+except ImportError:
+    host_frame = None
 
 CSV_HEADERS = ["host_name", "host_aliases", "os_info", "build_info", "host_apps", "sources", "last_reported_time", "host_status", "tags", "ipaddress"]
-CSV_DATA = []
+
+# Columns of a delta export, the tags, aliases and sources are those stored in the host store
+DELTA_HEADERS = ["change", "host_name", "last_reported_time", "tags", "aliases", "sources"]
 
 DD_API_KEY = ""
 DD_APP_KEY = ""
 DD_SITE = "api.datadoghq.com"
 
-def get_hosts(filters=None, start=None, count=1000, include_muted_hosts_data=0, include_hosts_metadata=1):
-    """API helper function for calling the Datadog API endpoint
-    
-    :returns: host request
+def get_os_info(host):
+    """OS name and build of Windows and macOS hosts, N/A for the others"""
+    meta = host.get("meta") or {}
+    os_version = meta.get("winV") or meta.get("macV")
+
+    if os_version:
+        return os_version[0], os_version[1]
+
+    return "N/A", "N/A"
+
+
+# How each column is read from a host
+COLUMNS = {
+    "host_name": lambda host: host.get("host_name", ""),
+    "host_aliases": lambda host: host.get("aliases", ""),
+    "os_info": lambda host: get_os_info(host)[0],
+    "build_info": lambda host: get_os_info(host)[1],
+    "host_apps": lambda host: host.get("apps", ""),
+    "sources": lambda host: host.get("sources", ""),
+    "last_reported_time": lambda host: host.get("last_reported_time", ""),
+    "host_status": lambda host: host.get("up", ""),
+    "tags": lambda host: host.get("tags_by_source", []),
+    # meta > gohai > network > ipaddress, without decoding the rest of gohai
+    "ipaddress": lambda host: host_inventory.gohai_field(host.get("meta") or {}, "network", "ipaddress"),
+    "muted": lambda host: host.get("is_muted", "")
+}
+
+# Columns read from the metadata of the hosts, which is only requested from the API when one of them is exported
+METADATA_COLUMNS = {"os_info", "build_info", "ipaddress"}
+
+# Columns read from the mute status of the hosts, which is only requested from the API when one of them is exported
+MUTE_COLUMNS = {"muted"}
+
+def build_hosts(response, columns=CSV_HEADERS):
+    """Builds the CSV rows of one page of hosts returned by the API
+
+    :param columns: columns of the rows, see COLUMNS
+    :returns: generator of CSV rows, one per host
     """
+    extractors = [COLUMNS[column] for column in columns]
 
-    # Build the headers for the request
-    headers = {
-        "DD-API-KEY": DD_API_KEY, 
-        "DD-APPLICATION-KEY": DD_APP_KEY
-        }
+    for host in response.get("host_list", []):
+        yield [extractor(host) for extractor in extractors]
 
-    # Build the params for the request
-    params = {
-        "filter": filters,
-        "start": start,
-        "count": count
-        }
+def export_delta(inventory, args, output_path):
+    """Refreshes the host store and writes the hosts the refresh added, removed or changed
+
+    :param host_inventory.HostInventory inventory: client used to read the hosts
+    :param args: parsed command line arguments
+    :param string output_path: path of the CSV file
+    """
+    store = host_store.HostStore(args.store)
 
-    # Try to make the request, raise exception if it fails
     try:
-        return requests.get(f"https://{DD_SITE}/api/v1/hosts", headers=headers, params=params).json()
-    except Exception as e:
-        raise Exception("Error when getting hosts from api: {}".format(e))
+        refresh = store.refresh(inventory, args.search, full=args.full, stale_hours=args.stale_hours)
+        refresh_kind = "Full" if refresh["from_time"] is None else "Incremental"
+        print(f"{refresh_kind} refresh of {args.store}: {refresh['host_count']} hosts read from API")
 
+        counts = {host_store.ADDED: 0, host_store.REMOVED: 0, host_store.CHANGED: 0}
+        open_output = gzip.open if args.gzip else open
 
-def build_hosts(response):
-    """ Pass in a json object with optional tag value from stdin and an optional header flag to check if it is for creating a new csv."""
-        
-    for host in response.get("host_list", []):
-        # Get all the properties of this host
-        host_name = host.get("host_name", "")
-        host_aliases = host.get("aliases", "")
-        host_apps = host.get("apps", "")
-        sources = host.get("sources", "")
-        last_reported_time = host.get("last_reported_time", "")
-        host_status = host.get("up", "")
-        tags = host.get("tags_by_source", [])
-
-        # Get ip address from meta > gohai > network > ipaddress if available
-        meta = host.get("meta", {})
-        gohai = json.loads(meta.get("gohai", "{}"))
-        network = gohai.get("network", {})
-        if network:
-            ip_address = network.get("ipaddress", "")
-        else:
-            ip_address = ""
-
-        windows_os_info = meta.get("winV", [])
-        mac_os_info = meta.get("macV", [])
-
-        if windows_os_info:
-            os_info = windows_os_info[0]
-            build_info = windows_os_info[1]
-        elif mac_os_info:
-            os_info = mac_os_info[0]
-            build_info = mac_os_info[1]
-        else:
-            os_info = "N/A"
-            build_info = "N/A"
-
-        # Build the row of data
-        host_info_row = [host_name, host_aliases, os_info, build_info, host_apps, sources, last_reported_time, host_status, tags, ip_address]
-
-        # Append it to our list of data
-        CSV_DATA.append(host_info_row)
+        with open_output(output_path, mode='wt', newline='') as delta_file:
+            delta_writer = csv.writer(delta_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+            delta_writer.writerow(DELTA_HEADERS)
+
+            for change, host in store.iter_delta():
+                delta_writer.writerow([change] + [host[column] for column in DELTA_HEADERS[1:]])
+                counts[change] += 1
+    finally:
+        store.close()
+
+    print(f"Hosts added: {counts[host_store.ADDED]}, removed: {counts[host_store.REMOVED]}, "
+          f"changed: {counts[host_store.CHANGED]}")
+    print(f"Delta written to {output_path}")
 
 # Main function to call api, create new file, write to new file, and save as .csv
 def main():
     # Get current time
     time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     
-    # Initialize tag argument variable
-    tag_arg = None
-    
-    # Get the argument from the command line if available
-    try:
-        tag_arg = sys.argv[1]
-    except IndexError: # No argument passed in
-        pass
+    parser = argparse.ArgumentParser(description="Writes every Datadog host matching a search to a CSV file")
+    parser.add_argument("search", nargs="?", help="optional host search, e.g. field:apps:agent")
+    parser.add_argument("--gzip", action="store_true", help="write a gzip compressed CSV file")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv",
+                        help="format of the host list, parquet requires pandas and pyarrow")
+    parser.add_argument("--output", help="path of the file (defaults to host_list_<CURRENTTIME>.csv)")
+    parser.add_argument("--columns", type=lambda value: value.split(","), default=CSV_HEADERS,
+                        help="comma separated columns to export, among: " + ", ".join(COLUMNS))
+    parser.add_argument("--store", help="SQLite host store to refresh, the hosts added, removed or changed since its "
+                                        "last refresh are written instead of every host")
+    parser.add_argument("--full", action="store_true", help="with --store, read every host instead of only the ones "
+                                                            "that reported since the last refresh")
+    parser.add_argument("--stale-hours", type=float, default=host_store.DEFAULT_STALE_HOURS,
+                        help="with --store, hours without reporting after which a host counts as removed")
+    args = parser.parse_args()
+
+    unknown_columns = [column for column in args.columns if column not in COLUMNS]
+    if unknown_columns:
+        parser.error("unknown column(s): " + ", ".join(unknown_columns))
+
+    if args.format == "parquet":
+        if args.gzip or args.store:
+            parser.error("--gzip and --store only write CSV files, Parquet files are always compressed")
+        if host_frame is None or host_frame.pq is None:
+            parser.error("pandas and pyarrow are required to write Parquet files, install them with: "
+                         "python3 -m pip install pandas pyarrow")
+
+    output_name = "host_delta" if args.store else "host_list"
+    output_path = args.output or f"{output_name}_{time}.{args.format}" + (".gz" if args.gzip else "")
+
+    inventory = host_inventory.HostInventory(DD_API_KEY, DD_APP_KEY, DD_SITE)
+
+    if args.store:
+        export_delta(inventory, args, output_path)
+        return
+
+    # The first page gives the number of hosts, the other pages are then requested in parallel
+    pages = inventory.iter_pages(
+        args.search,
+        include_hosts_metadata=bool(METADATA_COLUMNS.intersection(args.columns)),
+        include_muted_hosts_data=bool(MUTE_COLUMNS.intersection(args.columns))
+    )
+
+    # Read before the file is created so a search without hosts doesn't leave an empty file behind
+    first_page = next(pages)
+    host_count = first_page.get('total_matching')
 
-    # Initialize pagination counter
-    pagination_count = 0
+    # Print total number of hosts we are getting through
+    print(f"Total hosts to report from API: {host_count}")
 
-    # Do-while in python
-    while True:
-        # Make call out to get the hosts
-        hosts_response = get_hosts(filters=tag_arg, start=pagination_count)
+    if args.format == "parquet":
+        # Each page is turned into columns at once and written as a row group of the file
+        with host_frame.ParquetHostWriter(output_path, args.columns) as host_writer:
+            for hosts_response in itertools.chain([first_page], pages):
+                host_writer.write_frame(host_frame.page_frame(hosts_response, args.columns))
 
-        # Build the CSV list data
-        build_hosts(hosts_response)
+        print(f"Hosts written to {output_path}")
+        return
 
-        # Get total number of hosts returned by the API
-        host_count = hosts_response.get('total_matching')
-        
-        if not host_count or host_count == 0:
-            raise Exception("No hosts returned with the query. Please validate that your API/APP key are correct and the query returns hosts via the UI.")
+    open_output = gzip.open if args.gzip else open
 
-        # Increment by count
-        pagination_count += 1000
+    with open_output(output_path, mode='wt', newline='') as host_list_file:
+        host_writer = csv.writer(host_list_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
-        # If pagination count is greater than total number of hosts, break out
-        if pagination_count > host_count:
-            break
-    
-    # Print total number of hosts we are getting through
-    print(f"Total hosts to report from API: {host_count}")
+        host_writer.writerow(args.columns)
 
-    with open(f"host_list_{time}.csv", mode='w') as host_list_file:
-        host_writer = csv.writer(host_list_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        # Rows are written as each page arrives so only one page is held in memory, and every page is flushed so
+        # the file holds every host read so far if the run is interrupted
+        for hosts_response in itertools.chain([first_page], pages):
+            host_writer.writerows(build_hosts(hosts_response, args.columns))
+            host_list_file.flush()
 
-        host_writer.writerow(CSV_HEADERS)
+    print(f"Hosts written to {output_path}")
 
-        for host in CSV_DATA:
-            host_writer.writerow(host)
-        
 if __name__ == '__main__':
     main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# Generates a synthetic Datadog org (dashboards, monitors, synthetics and a tags map) to benchmark the tag replacer
+
+import argparse
+import json
+import random
+
+METRICS = ["system.cpu.user", "system.mem.used", "system.disk.in_use", "nginx.net.request_per_s", "redis.net.clients"]
+AGGREGATIONS = ["avg", "sum", "max", "min"]
+SYNTHETIC_TYPES = ["api", "browser", "mobile"]
+
+
+def build_tags_map(tag_count):
+    """Builds a tags map of old tag -> new tag
+
+    :param int tag_count: number of entries in the map
+    :return: dict of old tag -> new tag
+    """
+    return {"team{0}:old-value{0}".format(index): "team{0}:new-value{0}".format(index) for index in range(tag_count)}
+
+
+def pick_tag(rng, old_tags, hit_ratio):
+    """Picks a tag for a query, an old tag with probability hit_ratio, otherwise a tag that is never replaced"""
+    if old_tags and rng.random() < hit_ratio:
+        return rng.choice(old_tags)
+
+    return "env:bench{}".format(rng.randint(0, 50))
+
+
+def build_query(rng, old_tags, hit_ratio):
+    return "{}:{}{{{},{}}} by {{host}}".format(
+        rng.choice(AGGREGATIONS),
+        rng.choice(METRICS),
+        pick_tag(rng, old_tags, hit_ratio),
+        pick_tag(rng, old_tags, hit_ratio)
+    )
+
+
+def build_widget(rng, old_tags, hit_ratio, depth, widgets_per_group):
+    """Builds a widget, a group nesting other widgets while depth is above 1
+
+    Leaf widgets alternate between classic requests and formula/query requests.
+    """
+    if depth > 1:
+        return {
+            "definition": {
+                "type": "group",
+                "widgets": [build_widget(rng, old_tags, hit_ratio, depth - 1, widgets_per_group)
+                            for _ in range(widgets_per_group)]
+            }
+        }
+
+    if rng.random() < 0.5:
+        request = {"q": build_query(rng, old_tags, hit_ratio), "display_type": "line"}
+    else:
+        request = {
+            "queries": [{"data_source": "metrics", "name": "query1", "query": build_query(rng, old_tags, hit_ratio)}],
+            "formulas": [{"formula": "query1"}],
+            "response_format": "timeseries"
+        }
+
+    return {"definition": {"type": "timeseries", "title": "bench", "requests": [request]}}
+
+
+def generate_org(dashboard_count=100, widget_depth=2, widgets_per_group=4, monitor_count=500, synthetic_count=50,
+                 tag_count=100, hit_ratio=0.05, seed=42, host_count=0):
+    """Generates a synthetic org
+
+    :param int dashboard_count: number of dashboards
+    :param int widget_depth: nesting depth of the widgets of each dashboard (1 means no groups)
+    :param int widgets_per_group: number of widgets at each level
+    :param int monitor_count: number of monitors
+    :param int synthetic_count: number of synthetics
+    :param int tag_count: number of entries of the tags map
+    :param float hit_ratio: probability of a tag in a resource being one of the old tags
+    :param int seed: random seed, the same arguments always generate the same org
+    :param int host_count: number of hosts carrying user tags
+    :return: dict with the 'tags' map, the 'dashboards', 'monitors' and 'synthetics' of the org and the user tags of
+             its 'hosts'
+    """
+    rng = random.Random(seed)
+    tags = build_tags_map(tag_count)
+    old_tags = list(tags)
+
+    dashboards = {}
+    for index in range(dashboard_count):
+        dashboard_id = "ben-{:03d}-{:03d}".format(index // 1000, index % 1000)
+        dashboards[dashboard_id] = {
+            "id": dashboard_id,
+            "title": "Benchmark dashboard {}".format(index),
+            "layout_type": "ordered",
+            "modified_at": "2024-01-01T00:00:00.000000+00:00",
+            "widgets": [build_widget(rng, old_tags, hit_ratio, widget_depth, widgets_per_group)
+                        for _ in range(widgets_per_group)]
+        }
+
+    monitors = []
+    for index in range(monitor_count):
+        monitors.append({
+            "id": index + 1,
+            "name": "Benchmark monitor {}".format(index),
+            "type": "metric alert",
+            "query": "{}(last_5m):{} > 90".format(rng.choice(AGGREGATIONS), build_query(rng, old_tags, hit_ratio)),
+            "tags": [pick_tag(rng, old_tags, hit_ratio)],
+            "modified": "2024-01-01T00:00:00.000000+00:00",
+            "options": {}
+        })
+
+    synthetics = {}
+    for index in range(synthetic_count):
+        public_id = "syn-{:03d}-{:03d}".format(index // 1000, index % 1000)
+        synthetics[public_id] = {
+            "public_id": public_id,
+            "name": "Benchmark synthetic {}".format(index),
+            "type": SYNTHETIC_TYPES[index % len(SYNTHETIC_TYPES)],
+            "tags": [pick_tag(rng, old_tags, hit_ratio)],
+            "modified_at": "2024-01-01T00:00:00.000000+00:00",
+            "config": {"request": {"method": "GET", "url": "https://example.com"}, "assertions": []},
+            "locations": ["aws:us-east-1"]
+        }
+
+    hosts = {}
+    for index in range(host_count):
+        host_tags = [pick_tag(rng, old_tags, hit_ratio) for _ in range(3)]
+        hosts["bench-host-{:05d}".format(index)] = list(dict.fromkeys(host_tags))
+
+    return {"tags": tags, "dashboards": dashboards, "monitors": monitors, "synthetics": synthetics, "hosts": hosts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a synthetic Datadog org for tag replacer benchmarks")
+    parser.add_argument("output", help="path of the JSON file to write")
+    parser.add_argument("--dashboards", type=int, default=100)
+    parser.add_argument("--widget-depth", type=int, default=2)
+    parser.add_argument("--widgets-per-group", type=int, default=4)
+    parser.add_argument("--monitors", type=int, default=500)
+    parser.add_argument("--synthetics", type=int, default=50)
+    parser.add_argument("--hosts", type=int, default=0)
+    parser.add_argument("--tags", type=int, default=100)
+    parser.add_argument("--hit-ratio", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    org = generate_org(args.dashboards, args.widget_depth, args.widgets_per_group, args.monitors, args.synthetics,
+                       args.tags, args.hit_ratio, args.seed, args.hosts)
+
+    with open(args.output, "w") as output_file:
+        json.dump(org, output_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# Local stand-in for the Datadog dashboard, monitor and synthetics endpoints used by the tag replacer
+
+import argparse
+import collections
+import datetime
+import gzip
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import generate_org
+
+
+class MockDatadogAPI:
+    """Serves a generated org over HTTP the way the Datadog v1 API does
+
+    Every request waits `latency` seconds before being answered and a `rate_limit_ratio` share of them is answered
+    with a 429 instead. PUTs replace the stored resource and bump its modification time, so later GETs see the change.
+    Calls are counted per method and endpoint and can be read back from GET /_stats.
+    """
+
+    def __init__(self, org, latency=0.0, rate_limit_ratio=0.0, host="127.0.0.1", port=0, seed=42):
+        """
+        :param dict org: org built by generate_org.generate_org
+        :param float latency: seconds added to every response
+        :param float rate_limit_ratio: share of requests answered with a 429
+        :param string host: interface to listen on
+        :param int port: port to listen on (0 picks a free one)
+        :param int seed: random seed for the 429 injection
+        """
+        self.dashboards = org["dashboards"]
+        self.monitors = {monitor["id"]: monitor for monitor in org["monitors"]}
+        self.synthetics = org["synthetics"]
+        self.host_tags = org.get("hosts", {})
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.call_counts = collections.Counter()
+        self.rate_limited = 0
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}/api/v1/".format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, payload=None, headers=None):
+                body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self, method):
+                parsed = urllib.parse.urlparse(self.path)
+
+                if parsed.path == "/_stats":
+                    return self._send(200, api.stats())
+
+                path = parsed.path[len("/api/v1/"):]
+                params = dict(urllib.parse.parse_qsl(parsed.query))
+
+                body = None
+                if self.headers.get("content-length"):
+                    body = self.rfile.read(int(self.headers["content-length"]))
+
+                    if self.headers.get("content-encoding") == "gzip":
+                        body = gzip.decompress(body)
+
+                if api.latency:
+                    time.sleep(api.latency)
+
+                with api.lock:
+                    rate_limited = api.rng.random() < api.rate_limit_ratio
+                    if rate_limited:
+                        api.rate_limited += 1
+                    else:
+                        api.call_counts[(method, endpoint_name(path))] += 1
+
+                if rate_limited:
+                    return self._send(429, {"errors": ["Rate limit exceeded"]}, {"X-RateLimit-Reset": "0"})
+
+                status, payload = api.route(method, path, params, json.loads(body) if body else None)
+                self._send(status, payload)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+        return Handler
+
+    def stats(self):
+        """Calls answered so far, per "METHOD endpoint", and the number of requests answered with a 429"""
+        with self.lock:
+            calls = {"{} {}".format(method, endpoint): count for (method, endpoint), count in self.call_counts.items()}
+            return {"calls": calls, "rate_limited": self.rate_limited}
+
+    def route(self, method, path, params, body):
+        """Answers a request
+
+        :return: tuple of the status code and the JSON payload
+        """
+        parts = path.split("/")
+
+        if parts[0] == "dashboard":
+            if len(parts) == 1:
+                return 200, {"dashboards": [{"id": dashboard_id, "modified_at": dashboard["modified_at"]}
+                                            for dashboard_id, dashboard in self.dashboards.items()]}
+            return self._resource(self.dashboards, parts[1], method, body)
+
+        if parts[0] == "monitor":
+            if len(parts) == 1:
+                return 200, self._monitor_page(params)
+            return self._resource(self.monitors, int(parts[1]), method, body)
+
+        if parts[:2] == ["tags", "hosts"]:
+            if len(parts) == 2:
+                return 200, {"tags": self._hosts_by_tag()}
+            return self._host_tags(urllib.parse.unquote(parts[2]), method, body)
+
+        if parts[:2] == ["synthetics", "tests"]:
+            if len(parts) == 2:
+                return 200, {"tests": [{key: synthetic[key] for key in ("public_id", "type", "tags", "modified_at")}
+                                       for synthetic in self.synthetics.values()]}
+            return self._resource(self.synthetics, parts[-1], method, body)
+
+        return 404, {"errors": ["Not found"]}
+
+    def _resource(self, store, resource_id, method, body):
+        if resource_id not in store:
+            return 404, {"errors": ["Not found"]}
+
+        if method == "PUT":
+            with self.lock:
+                store[resource_id] = dict(store[resource_id], **body)
+
+                # Like the API, a PUT bumps the modification time of the resource
+                for key in ("modified_at", "modified"):
+                    if key in store[resource_id]:
+                        store[resource_id][key] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            return 200, store[resource_id]
+
+        return 200, store[resource_id]
+
+    def _hosts_by_tag(self):
+        with self.lock:
+            hosts_by_tag = collections.defaultdict(list)
+            for host_name, host_tags in self.host_tags.items():
+                for tag in host_tags:
+                    hosts_by_tag[tag].append(host_name)
+            return hosts_by_tag
+
+    def _host_tags(self, host_name, method, body):
+        if host_name not in self.host_tags:
+            return 404, {"errors": ["Not found"]}
+
+        if method == "PUT":
+            with self.lock:
+                self.host_tags[host_name] = list(body["tags"])
+
+        return 200, {"host": host_name, "tags": self.host_tags[host_name]}
+
+    def _monitor_page(self, params):
+        monitors = list(self.monitors.values())
+
+        if params.get("monitor_tags"):
+            monitors = [monitor for monitor in monitors if params["monitor_tags"] in monitor["tags"]]
+        if params.get("tags"):
+            monitors = [monitor for monitor in monitors if params["tags"] in monitor["query"]]
+
+        if "page" not in params:
+            return monitors
+
+        page, page_size = int(params["page"]), int(params.get("page_size", 100))
+        return monitors[page * page_size:(page + 1) * page_size]
+
+
+def endpoint_name(path):
+    """Collapses resource ids out of a path so calls can be counted per endpoint"""
+    parts = path.split("/")
+
+    if parts[0] in ("dashboard", "monitor"):
+        return parts[0] if len(parts) == 1 else parts[0] + "/{id}"
+
+    if len(parts) <= 2:
+        return path
+
+    return "/".join(parts[:-1]) + "/{id}"
+
+
+def serve(generator_args, latency, rate_limit_ratio, connection):
+    """Generates an org and serves it until the process is terminated, used to run the API in its own process
+
+    :param dict generator_args: keyword arguments of generate_org.generate_org
+    :param float latency: seconds added to every response
+    :param float rate_limit_ratio: share of requests answered with a 429
+    :param connection: multiprocessing connection the base URL is sent back on once the API is up
+    """
+    api = MockDatadogAPI(generate_org.generate_org(**generator_args), latency, rate_limit_ratio).start()
+    connection.send(api.base_url)
+    api.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves a generated org the way the Datadog API does")
+    parser.add_argument("org", help="JSON file written by generate_org.py")
+    parser.add_argument("--port", type=int, default=8126)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0)
+    args = parser.parse_args()
+
+    with open(args.org) as org_file:
+        org = json.load(org_file)
+
+    api = MockDatadogAPI(org, args.latency_ms / 1000, args.rate_limit_ratio, port=args.port).start()
+    print("Serving {} at {}".format(args.org, api.base_url))
+
+    try:
+        api.thread.join()
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# Runs the tag replacer against a generated org served by the local mock API and reports its throughput
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import generate_org
+import helpers
+import metrics
+import mock_api
+import replacer
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of values (0 if empty)"""
+    if not values:
+        return 0
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))]
+
+
+def time_resources(latencies):
+    """Wraps replacer's per-resource functions so the time spent on each resource is appended to
+    latencies[resource type]
+
+    Synthetics and hosts are only timed when they carry an old tag, the others are never fetched or written.
+    """
+    for resource_type in replacer.RESOURCE_TYPES:
+        resource_latencies = latencies[resource_type] = []
+        update_resource = getattr(replacer, "update_" + resource_type)
+        update_resource_async = getattr(replacer, "update_{}_async".format(resource_type))
+
+        def timed_update_resource(*args, update_resource=update_resource, resource_latencies=resource_latencies,
+                                  **kwargs):
+            start = time.perf_counter()
+            try:
+                return update_resource(*args, **kwargs)
+            finally:
+                resource_latencies.append(time.perf_counter() - start)
+
+        async def timed_update_resource_async(*args, update_resource_async=update_resource_async,
+                                              resource_latencies=resource_latencies, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await update_resource_async(*args, **kwargs)
+            finally:
+                resource_latencies.append(time.perf_counter() - start)
+
+        setattr(replacer, "update_" + resource_type, timed_update_resource)
+        setattr(replacer, "update_{}_async".format(resource_type), timed_update_resource_async)
+
+
+def benchmark_rewrite(org, tags):
+    """Times helpers.find_and_replace_tags on every monitor query of the org
+
+    :return: list of seconds spent per query
+    """
+    latencies = []
+
+    for monitor in org["monitors"]:
+        start = time.perf_counter()
+        helpers.find_and_replace_tags(monitor["query"], tags)
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def run(args):
+    generator_args = {
+        "dashboard_count": args.dashboards,
+        "widget_depth": args.widget_depth,
+        "widgets_per_group": args.widgets_per_group,
+        "monitor_count": args.monitors,
+        "synthetic_count": args.synthetics,
+        "tag_count": args.tags,
+        "hit_ratio": args.hit_ratio,
+        "seed": args.seed,
+        "host_count": args.hosts
+    }
+
+    # The mock API runs in its own process so its memory and CPU don't count against the replacer
+    parent_connection, child_connection = multiprocessing.Pipe()
+    api_process = multiprocessing.Process(
+        target=mock_api.serve,
+        args=(generator_args, args.latency_ms / 1000, args.rate_limit_ratio, child_connection),
+        daemon=True
+    )
+    api_process.start()
+    base_url = parent_connection.recv()
+
+    try:
+        tags = helpers.TagMatcher(generate_org.build_tags_map(args.tags), args.query_cache_size)
+        targets = {resource_type: None for resource_type in replacer.RESOURCE_TYPES}
+        targets["host"] = None if args.hosts else False
+        replacer.RUN_MODE = args.mode
+
+        resource_latencies = {}
+        time_resources(resource_latencies)
+
+        start = time.perf_counter()
+
+        if args.engine == "async":
+            client = helpers.AsyncDatadogClient("bench", "bench", concurrency=args.concurrency)
+            client.base_url = base_url
+            asyncio.run(replacer.run_async(client, tags, targets, monitor_page_size=args.monitor_page_size))
+        else:
+            client = helpers.DatadogClient("bench", "bench", pool_size=args.concurrency)
+            client.base_url = base_url
+            replacer.run_sync(client, tags, targets, args.concurrency, monitor_page_size=args.monitor_page_size)
+
+        elapsed = time.perf_counter() - start
+
+        with urllib.request.urlopen(base_url.replace("/api/v1/", "/_stats")) as response:
+            api_stats = json.load(response)
+    finally:
+        api_process.terminate()
+
+    run_totals = metrics.RUN_STATS.totals()
+    query_cache = tags.cache_info()
+
+    # Rewrite micro benchmark, on an org generated locally once the run is over so it doesn't affect the peak RSS
+    # with a matcher of its own so the queries the run already rewrote are not served from its cache
+    rewrite_latencies = benchmark_rewrite(generate_org.generate_org(**generator_args),
+                                          helpers.TagMatcher(tags.tags, args.query_cache_size))
+
+    resource_count = args.dashboards + args.monitors + args.synthetics + args.hosts
+
+    return {
+        "engine": args.engine,
+        "mode": args.mode,
+        "resources": resource_count,
+        "elapsed_seconds": round(elapsed, 3),
+        "resources_per_second": round(resource_count / elapsed, 1),
+        "latency_ms": {
+            resource_type: {
+                "count": len(latencies),
+                "p50": round(percentile(latencies, 50) * 1000, 3),
+                "p99": round(percentile(latencies, 99) * 1000, 3)
+            }
+            for resource_type, latencies in resource_latencies.items()
+        },
+        "find_and_replace_tags_us": {
+            "p50": round(percentile(rewrite_latencies, 50) * 1e6, 3),
+            "p99": round(percentile(rewrite_latencies, 99) * 1e6, 3),
+            "mean": round(statistics.mean(rewrite_latencies) * 1e6, 3) if rewrite_latencies else 0
+        },
+        "api_calls": api_stats["calls"],
+        "api_calls_total": sum(api_stats["calls"].values()),
+        "rate_limited": api_stats["rate_limited"],
+        "query_cache": query_cache,
+        "phase_seconds": {phase: round(seconds, 3) for phase, (seconds, _) in run_totals["phases"].items()},
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the tag replacer against a local mock Datadog API")
+    parser.add_argument("--dashboards", type=int, default=100)
+    parser.add_argument("--widget-depth", type=int, default=2)
+    parser.add_argument("--widgets-per-group", type=int, default=4)
+    parser.add_argument("--monitors", type=int, default=500)
+    parser.add_argument("--synthetics", type=int, default=50)
+    parser.add_argument("--hosts", type=int, default=0, help="number of hosts carrying user tags")
+    parser.add_argument("--tags", type=int, default=100, help="number of entries in the tags map")
+    parser.add_argument("--hit-ratio", type=float, default=0.05, help="probability of a tag being an old tag")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--latency-ms", type=float, default=5, help="latency added by the mock API to every call")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0, help="share of calls answered with a 429")
+    parser.add_argument("--concurrency", type=int, default=replacer.DEFAULT_CONCURRENCY)
+    parser.add_argument("--monitor-page-size", type=int, default=helpers.DEFAULT_MONITOR_PAGE_SIZE)
+    parser.add_argument("--query-cache-size", type=int, default=helpers.DEFAULT_QUERY_CACHE_SIZE)
+    parser.add_argument("--mode", choices=["test", "prod"], default="test")
+    parser.add_argument("--engine", choices=["sync", "async"], default="sync")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # Keep the replacer's own report out of the benchmark output
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        results = run(args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
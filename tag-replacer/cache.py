@@ -0,0 +1,112 @@
+import gzip
+import hashlib
+import os
+import threading
+
+DEFAULT_MAX_MB = 512
+
+
+class DefinitionCache:
+    """Local gzip compressed cache of resource definitions keyed by (id, modified_at)
+
+    The server copy of a definition is stored as it was downloaded, before any tag is replaced, so the same cache can
+    be used by test and prod runs. A definition is only served while the modified_at from the list endpoint still
+    matches, any change on the server misses the cache and replaces the stale entry. Once the cache grows past its
+    size limit the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_MB * 1024 * 1024):
+        """
+        :param string directory: folder the cached definitions are written to (created if it doesn't exist)
+        :param int max_bytes: max size of the cache on disk
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+        # resource id -> path of the version currently cached
+        self.index = {}
+        self.total_bytes = 0
+
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".json.gz"):
+                resource_id = entry.name[:-len(".json.gz")].rsplit(".", 1)[0]
+                self.index[resource_id] = entry.path
+                self.total_bytes += entry.stat().st_size
+
+    def _path(self, resource_id, modified_at):
+        version = hashlib.sha1(str(modified_at).encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.directory, "{}.{}.json.gz".format(resource_id, version))
+
+    def get(self, resource_id, modified_at):
+        """Returns the cached definition if it was stored for the same modified_at
+
+        :param string resource_id: id of the resource
+        :param string modified_at: modified_at of the resource from the list endpoint
+        :return: raw JSON bytes of the definition, or None on a miss
+        """
+        if modified_at is None:
+            return None
+
+        path = self._path(resource_id, modified_at)
+
+        try:
+            with gzip.open(path, "rb") as cache_file:
+                raw = cache_file.read()
+
+            # Mark the entry as recently used for eviction
+            os.utime(path)
+        except (OSError, EOFError):
+            return None
+
+        return raw
+
+    def put(self, resource_id, modified_at, raw):
+        """Stores a definition, replacing any older version of the same resource
+
+        :param string resource_id: id of the resource
+        :param string modified_at: modified_at of the resource from the list endpoint
+        :param bytes raw: raw JSON bytes of the definition as returned by the API
+        :return:
+        """
+        if modified_at is None:
+            return
+
+        path = self._path(resource_id, modified_at)
+        temp_path = "{}.{}.tmp".format(path, threading.get_ident())
+
+        with gzip.open(temp_path, "wb", compresslevel=6) as cache_file:
+            cache_file.write(raw)
+
+        with self.lock:
+            # Drop the older version of this resource
+            if str(resource_id) in self.index:
+                self._remove(self.index.pop(str(resource_id)))
+
+            os.replace(temp_path, path)
+            self.index[str(resource_id)] = path
+            self.total_bytes += os.path.getsize(path)
+
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.total_bytes -= size
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Removes least recently used entries until the cache is back under 90% of its size limit"""
+        entries = sorted(self.index.items(), key=lambda item: os.path.getmtime(item[1]))
+
+        for resource_id, path in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+
+            self._remove(path)
+            del self.index[resource_id]
@@ -1,5 +1,40 @@
 import requests
+import asyncio
+import collections
+import gzip
+import hashlib
+import json
+import os
+import random
 import re
+import sys
+import threading
+import time
+import urllib.parse
+import metrics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+# Bounded windows of work, shared with the host scripts
+from work_pool import iter_bounded, iter_bounded_async
+
+try:
+    # Optional, lets monitor pages be parsed incrementally as they are downloaded
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    # Optional, only required to run in ASYNC_MODE
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    # Optional, encodes and decodes API payloads several times faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
 
 DASHBOARD_EXTRA_CONFIGS = [
     "author_name",
@@ -29,6 +64,619 @@ SYNTHETIC_EXTRA_CONFIGS = [
     "monitor_id",
 ]
 
+# API path of each synthetic test type that can be updated, synthetics of other types are reported as errors
+SYNTHETIC_PATHS = {
+    "api": "synthetics/tests/api/{}",
+    "browser": "synthetics/tests/browser/{}",
+    "mobile": "synthetics/tests/mobile/{}"
+}
+
+# Only the host tags added through the API or the UI can be changed, tags from integrations (aws, chef...) are read-only
+HOST_TAGS_SOURCE = "users"
+
+# Widgets that don't contain any query we can rewrite
+UNSUPPORTED_WIDGET_TYPES = {
+    "alert_value",
+    "check_status",
+    "alert_graph",
+    "slo",
+    "image",
+    "trace_service",
+    "free_text",
+    "iframe"
+}
+
+# Request keys holding queries we don't rewrite (logs, apm, network and rum)
+IGNORED_QUERY_KEYS = ("log_query", "apm_query", "rum_query", "network_query")
+
+# Formula query data sources whose 'query' field is a metric query
+METRIC_DATA_SOURCES = ("metrics",)
+
+
+# Status codes that are worth retrying: rate limited or a transient server side error
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_POOL_SIZE = 10
+
+# Upper bound (in seconds) for a single backoff sleep
+MAX_BACKOFF = 60
+
+DEFAULT_MONITOR_PAGE_SIZE = 1000
+
+# Number of rewritten query strings remembered by a TagMatcher
+DEFAULT_QUERY_CACHE_SIZE = 10000
+
+# Compression level of gzip compressed request bodies, favours speed as bodies are only compressed once
+GZIP_LEVEL = 5
+
+# Field holding the last modification time of each resource type
+MODIFIED_KEYS = {
+    "dashboard": "modified_at",
+    "monitor": "modified",
+    "synthetic": "modified_at"
+}
+
+# Wildcard of the pattern rules of the tags map, e.g. "env:dev-*": "environment:dev-*"
+TAG_WILDCARD = "*"
+
+# Characters a wildcard can stand for: anything allowed in a tag except the separators used in queries
+WILDCARD_CHARACTERS = r"[\w.\-/:]"
+
+# Pattern rules only match a whole tag inside the scope of a query ({env:prod,!role:db}, {host IN (a,b)}, by {host}),
+# so a rule can't rewrite the aggregator or metric name of a query
+TAG_START = r"(?<![^\s{,(!])"
+TAG_END = r"(?![^\s},)])"
+SCOPE_PATTERN = re.compile(r"(\{[^{}]*\})")
+
+# Run of tag characters, e.g. "env:dev-1" around the old tag "env:dev"
+TAG_CHARACTER = re.compile(WILDCARD_CHARACTERS)
+TAG_TAIL = re.compile(WILDCARD_CHARACTERS + "*")
+
+
+def json_loads(raw):
+    """Decodes a JSON payload, with orjson if it is installed
+
+    :param raw: bytes or string holding the JSON
+    :return: the decoded value
+    """
+    if orjson is not None:
+        return orjson.loads(raw)
+
+    return json.loads(raw)
+
+
+def json_dumps(value):
+    """Encodes a value to compact JSON bytes, with orjson if it is installed
+
+    :param value: value to encode
+    :return: UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            # orjson is stricter than the json module (e.g. integers over 64 bits, non string keys)
+            pass
+
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def encode_body(body, gzip_min_bytes=None):
+    """Builds the payload of a request
+
+    :param body: dict to send, or bytes already holding its JSON (sent as is, so a body that did not change since it
+                 was encoded is never encoded again)
+    :param int gzip_min_bytes: bodies at least this big are gzip compressed (never compressed if None)
+    :return: tuple of the payload bytes (None without a body) and the extra headers to send with it
+    """
+    if body is None:
+        return None, {}
+
+    data = body if isinstance(body, bytes) else json_dumps(body)
+
+    if gzip_min_bytes and len(data) >= gzip_min_bytes:
+        return gzip.compress(data, compresslevel=GZIP_LEVEL), {"Content-Encoding": "gzip"}
+
+    return data, {}
+
+
+def get_backoff(attempt, headers=None):
+    """Seconds to sleep before retrying a call (full jitter, honours the rate limit reset header if sent)
+
+    :param int attempt: number of attempts already made
+    :param headers: headers of the failed response, if there was one
+    :return: seconds to sleep
+    """
+    delay = random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+
+    if headers is not None:
+        reset = headers.get("X-RateLimit-Reset") or headers.get("Retry-After")
+        if reset and reset.isdigit():
+            delay = max(delay, min(MAX_BACKOFF, int(reset)))
+
+    return delay
+
+
+class RateLimiter:
+    """Token bucket spreading the calls of a client over time so they stay under a requests per second budget
+
+    Callers reserve a token before each call and are told how long to wait for it, which works the same for threads
+    (time.sleep) and asyncio tasks (asyncio.sleep).
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param float rate: requests per second allowed on average
+        :param int burst: max number of requests sent back to back after an idle period (defaults to one second worth)
+        """
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token from the bucket
+
+        :return: seconds to wait before the call can be made
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            if self.tokens >= 0:
+                return 0
+
+            return -self.tokens / self.rate
+
+
+def get_site(eu_customer=False, site=None):
+    """Works out which Datadog site the API calls should go to
+
+    :param boolean eu_customer: True if customer is in EU, otherwise false
+    :param string site: explicit Datadog site (e.g. us3.datadoghq.com), takes precedence over eu_customer
+    :return: the Datadog site
+    """
+    if site:
+        return site
+
+    if str(eu_customer) == "True":
+        return "datadoghq.eu"
+
+    return "datadoghq.com"
+
+
+class DatadogClient:
+    """Reusable client for the DD API
+
+    Keeps a pool of keep-alive connections open to the Datadog site so consecutive calls don't pay for a new
+    connection each time, applies a timeout to every request and retries rate limited (429) and 5xx responses with
+    jittered exponential backoff.
+    """
+
+    def __init__(self, dd_api_key, dd_app_key, eu_customer=False, site=None, timeout=DEFAULT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, pool_size=DEFAULT_POOL_SIZE, stats=None, rate_limit=None,
+                 gzip_min_bytes=None):
+        """
+        :param string dd_api_key: Datadog api key used to authenticate to API
+        :param string dd_app_key: Datadog app key used to authenticate to API
+        :param boolean eu_customer: True if customer is in EU, otherwise false
+        :param string site: explicit Datadog site (e.g. us3.datadoghq.com), takes precedence over eu_customer
+        :param int timeout: seconds to wait on the API before giving up on a request
+        :param int max_retries: how many times a failed request is retried before raising
+        :param int pool_size: max number of connections kept open (should match the number of workers)
+        :param metrics.RunStats stats: where API calls are recorded (defaults to metrics.RUN_STATS)
+        :param float rate_limit: max requests per second sent by the client, retries included (no limit if None)
+        :param int gzip_min_bytes: request bodies at least this big are sent gzip compressed (never if None)
+        """
+        self.base_url = "https://api.{}/api/v1/".format(get_site(eu_customer, site))
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.stats = stats if stats is not None else metrics.RUN_STATS
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.gzip_min_bytes = gzip_min_bytes
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "content-type": "application/json",
+            "DD-API-KEY": dd_api_key,
+            "DD-APPLICATION-KEY": dd_app_key
+        })
+
+    def request(self, request_path, method="GET", body=None, params=None, stream=False):
+        """Calls the DD API, retrying on rate limits and transient errors
+
+        :param string request_path: the endpoint that we are calling from the Datadog API
+        :param string method: the method we are using when calling API
+        :param body: the body of the request if we are updating/creating a value via API (dict, or bytes of JSON
+                     already encoded)
+        :param dict params: query string parameters of the request
+        :param boolean stream: True to leave the response body unread so it can be consumed incrementally
+        :return: the successful requests.Response
+        """
+        method = method.upper()
+
+        if method not in ("GET", "PUT"):
+            raise Exception("Unsupported API Call type.")
+
+        if method == "PUT" and body is None:
+            raise Exception("A valid body is required to make a PUT request. Please try again")
+
+        url = self.base_url + request_path
+
+        with self.stats.timer("encode"):
+            data, headers = encode_body(body, self.gzip_min_bytes)
+
+        start = time.perf_counter()
+
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                wait = self.rate_limiter.reserve()
+                if wait:
+                    time.sleep(wait)
+
+            try:
+                results = self.session.request(method, url, data=data, headers=headers, params=params,
+                                               timeout=self.timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == self.max_retries:
+                    self.stats.record_call(method, request_path, time.perf_counter() - start, 0,
+                                           bytes_out=len(data or b""), retries=attempt)
+                    raise Exception("Unable to reach DD API for {}: {}".format(request_path, e)) from e
+
+                time.sleep(get_backoff(attempt))
+                continue
+
+            if results.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                time.sleep(get_backoff(attempt, results.headers))
+                continue
+
+            if results.status_code == 415 and headers and attempt < self.max_retries:
+                # The endpoint doesn't take compressed bodies, stop compressing them
+                self.gzip_min_bytes = None
+                data, headers = encode_body(body)
+                continue
+
+            # Streamed bodies are not read yet, the caller adds their size as it reads them
+            bytes_in = 0 if stream else len(results.content)
+
+            self.stats.record_call(method, request_path, time.perf_counter() - start, results.status_code,
+                                   bytes_in, len(data or b""), attempt)
+
+            try:
+                # Raise an error if there was one
+                results.raise_for_status()
+            except requests.exceptions.HTTPError as e:
+                raise Exception("Non-200 response code returned from DD API for {}: {} {}".format(
+                    request_path, results.status_code, results.text)) from e
+
+            return results
+
+    def call(self, request_path, method="GET", body=None, params=None):
+        """Calls the DD API and decodes the response
+
+        :param string request_path: the endpoint that we are calling from the Datadog API
+        :param string method: the method we are using when calling API
+        :param body: the body of the request if we are updating/creating a value via API (dict, or bytes of JSON
+                     already encoded)
+        :param dict params: query string parameters of the request
+        :return: json of request made
+        """
+        results = self.request(request_path, method, body, params)
+
+        with self.stats.timer("decode"):
+            return json_loads(results.content)
+
+    def get_raw(self, request_path):
+        """GETs an endpoint without decoding the response
+
+        :param string request_path: the endpoint that we are calling from the Datadog API
+        :return: raw bytes of the response body
+        """
+        return self.request(request_path).content
+
+
+class AsyncDatadogClient:
+    """asyncio counterpart of DatadogClient, built on aiohttp
+
+    Every call made through the client, whatever the resource type, waits on the same semaphore so the number of
+    requests in flight never exceeds the configured concurrency. Must be used as an async context manager.
+    """
+
+    def __init__(self, dd_api_key, dd_app_key, eu_customer=False, site=None, timeout=DEFAULT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, concurrency=DEFAULT_POOL_SIZE, stats=None, rate_limit=None,
+                 gzip_min_bytes=None):
+        """
+        :param string dd_api_key: Datadog api key used to authenticate to API
+        :param string dd_app_key: Datadog app key used to authenticate to API
+        :param boolean eu_customer: True if customer is in EU, otherwise false
+        :param string site: explicit Datadog site (e.g. us3.datadoghq.com), takes precedence over eu_customer
+        :param int timeout: seconds to wait on the API before giving up on a request
+        :param int max_retries: how many times a failed request is retried before raising
+        :param int concurrency: max number of requests in flight at the same time
+        :param metrics.RunStats stats: where API calls are recorded (defaults to metrics.RUN_STATS)
+        :param float rate_limit: max requests per second sent by the client, retries included (no limit if None)
+        :param int gzip_min_bytes: request bodies at least this big are sent gzip compressed (never if None)
+        """
+        if aiohttp is None:
+            raise Exception("The aiohttp library is required to run in ASYNC_MODE. Please install it and run again.")
+
+        self.base_url = "https://api.{}/api/v1/".format(get_site(eu_customer, site))
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.concurrency = concurrency
+        self.stats = stats if stats is not None else metrics.RUN_STATS
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.gzip_min_bytes = gzip_min_bytes
+        self.headers = {
+            "content-type": "application/json",
+            "DD-API-KEY": dd_api_key,
+            "DD-APPLICATION-KEY": dd_app_key
+        }
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            connector=aiohttp.TCPConnector(limit=self.concurrency)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.session.close()
+
+    async def request(self, request_path, method="GET", body=None, params=None):
+        """Calls the DD API, retrying on rate limits and transient errors
+
+        :param string request_path: the endpoint that we are calling from the Datadog API
+        :param string method: the method we are using when calling API
+        :param body: the body of the request if we are updating/creating a value via API (dict, or bytes of JSON
+                     already encoded)
+        :param dict params: query string parameters of the request
+        :return: raw bytes of the response body
+        """
+        method = method.upper()
+
+        if method not in ("GET", "PUT"):
+            raise Exception("Unsupported API Call type.")
+
+        if method == "PUT" and body is None:
+            raise Exception("A valid body is required to make a PUT request. Please try again")
+
+        url = self.base_url + request_path
+        if params:
+            params = {key: str(value) for key, value in params.items()}
+
+        with self.stats.timer("encode"):
+            data, headers = encode_body(body, self.gzip_min_bytes)
+
+        start = time.perf_counter()
+
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                wait = self.rate_limiter.reserve()
+                if wait:
+                    await asyncio.sleep(wait)
+
+            try:
+                async with self.semaphore:
+                    async with self.session.request(method, url, data=data, headers=headers,
+                                                    params=params) as results:
+                        content = await results.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    self.stats.record_call(method, request_path, time.perf_counter() - start, 0,
+                                           bytes_out=len(data or b""), retries=attempt)
+                    raise Exception("Unable to reach DD API for {}: {}".format(request_path, e)) from e
+
+                await asyncio.sleep(get_backoff(attempt))
+                continue
+
+            if results.status in RETRY_STATUS_CODES and attempt < self.max_retries:
+                await asyncio.sleep(get_backoff(attempt, results.headers))
+                continue
+
+            if results.status == 415 and headers and attempt < self.max_retries:
+                # The endpoint doesn't take compressed bodies, stop compressing them
+                self.gzip_min_bytes = None
+                data, headers = encode_body(body)
+                continue
+
+            self.stats.record_call(method, request_path, time.perf_counter() - start, results.status, len(content),
+                                   len(data or b""), attempt)
+
+            if results.status >= 400:
+                raise Exception("Non-200 response code returned from DD API for {}: {} {}".format(
+                    request_path, results.status, content.decode("utf-8", "replace")))
+
+            return content
+
+    async def call(self, request_path, method="GET", body=None, params=None):
+        """Calls the DD API and decodes the response
+
+        :param string request_path: the endpoint that we are calling from the Datadog API
+        :param string method: the method we are using when calling API
+        :param body: the body of the request if we are updating/creating a value via API (dict, or bytes of JSON
+                     already encoded)
+        :param dict params: query string parameters of the request
+        :return: json of request made
+        """
+        content = await self.request(request_path, method, body, params)
+
+        with self.stats.timer("decode"):
+            return json_loads(content)
+
+    async def get_raw(self, request_path):
+        """GETs an endpoint without decoding the response
+
+        :param string request_path: the endpoint that we are calling from the Datadog API
+        :return: raw bytes of the response body
+        """
+        return await self.request(request_path)
+
+
+class _CountingReader:
+    """File-like wrapper of a response body counting the bytes read through it"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def iter_monitors(client, page_size=DEFAULT_MONITOR_PAGE_SIZE, params=None, prefilter=None):
+    """Yields the monitors of the account one page at a time so only a single page is ever held in memory
+
+    When ijson is installed and no prefilter is given, each page is parsed incrementally while it is downloaded.
+    Otherwise a page is downloaded whole and checked against the prefilter first: pages without any old tag are skipped
+    without decoding them.
+
+    :param DatadogClient client: client used to call the monitor endpoint
+    :param int page_size: number of monitors requested per page
+    :param dict params: extra query string parameters used to filter monitors server side
+    :param TagMatcher prefilter: old tags used to skip pages that can't contain a match
+    :return: generator of monitor configs
+    """
+    page = 0
+
+    while True:
+        page_params = dict(params or {}, page=page, page_size=page_size)
+
+        if ijson is not None and prefilter is None:
+            results = client.request("monitor", params=page_params, stream=True)
+
+            body = _CountingReader(results.raw)
+
+            try:
+                results.raw.decode_content = True
+
+                monitor_count = 0
+                for monitor in ijson.items(body, "item", use_float=True):
+                    monitor_count += 1
+                    yield monitor
+            finally:
+                # Gives the connection back to the pool even if the caller stops early
+                results.close()
+                client.stats.add_bytes_in("GET", "monitor", body.bytes_read)
+        else:
+            results = client.request("monitor", params=page_params)
+
+            if results.content.strip() == b"[]":
+                break
+
+            with client.stats.timer("prefilter"):
+                page_hit = prefilter is None or prefilter.search_raw(results.content)
+
+            if not page_hit:
+                # Page has monitors but none of them mention an old tag, so don't bother decoding it
+                page += 1
+                continue
+
+            with client.stats.timer("decode"):
+                monitors = json_loads(results.content)
+            monitor_count = len(monitors)
+            yield from monitors
+
+        if monitor_count < page_size:
+            break
+
+        page += 1
+
+
+def iter_matching_monitors(client, old_tags, page_size=DEFAULT_MONITOR_PAGE_SIZE):
+    """Yields only the monitors the API reports as tagged with, or scoped to, one of the old tags
+
+    The monitor endpoint ANDs the tags it is given, so each old tag is requested separately (once as a monitor tag,
+    once as a scope tag) and monitors returned more than once are only yielded the first time. Worth it when the tags
+    map is small compared to the number of monitors in the account.
+
+    :param DatadogClient client: client used to call the monitor endpoint
+    :param old_tags: iterable of the old tags
+    :param int page_size: number of monitors requested per page
+    :return: generator of monitor configs
+    """
+    seen_ids = set()
+
+    for old_tag in old_tags:
+        for filter_param in ("monitor_tags", "tags"):
+            for monitor in iter_monitors(client, page_size, {filter_param: old_tag}):
+                if monitor["id"] in seen_ids:
+                    continue
+
+                seen_ids.add(monitor["id"])
+                yield monitor
+
+
+async def iter_monitors_async(client, page_size=DEFAULT_MONITOR_PAGE_SIZE, params=None, prefilter=None):
+    """asyncio counterpart of iter_monitors, yields the monitors of the account one page at a time
+
+    :param AsyncDatadogClient client: client used to call the monitor endpoint
+    :param int page_size: number of monitors requested per page
+    :param dict params: extra query string parameters used to filter monitors server side
+    :param TagMatcher prefilter: old tags used to skip pages that can't contain a match
+    :return: async generator of monitor configs
+    """
+    page = 0
+
+    while True:
+        content = await client.request("monitor", params=dict(params or {}, page=page, page_size=page_size))
+
+        if content.strip() == b"[]":
+            break
+
+        with client.stats.timer("prefilter"):
+            page_hit = prefilter is None or prefilter.search_raw(content)
+
+        if page_hit:
+            with client.stats.timer("decode"):
+                monitors = json_loads(content)
+
+            for monitor in monitors:
+                yield monitor
+
+            if len(monitors) < page_size:
+                break
+
+        page += 1
+
+
+async def iter_matching_monitors_async(client, old_tags, page_size=DEFAULT_MONITOR_PAGE_SIZE):
+    """asyncio counterpart of iter_matching_monitors
+
+    :param AsyncDatadogClient client: client used to call the monitor endpoint
+    :param old_tags: iterable of the old tags
+    :param int page_size: number of monitors requested per page
+    :return: async generator of monitor configs
+    """
+    seen_ids = set()
+
+    for old_tag in old_tags:
+        for filter_param in ("monitor_tags", "tags"):
+            async for monitor in iter_monitors_async(client, page_size, {filter_param: old_tag}):
+                if monitor["id"] in seen_ids:
+                    continue
+
+                seen_ids.add(monitor["id"])
+                yield monitor
+
+
+# Clients created by call_api, keyed by credentials and site
+_CLIENTS = {}
+
 
 def call_api(request_path, dd_api_key, dd_app_key, eu_customer=False, method="GET", body=None):
     """Helper function used to call the DD API
@@ -41,140 +689,617 @@ def call_api(request_path, dd_api_key, dd_app_key, eu_customer=False, method="GE
     :param dict body: the body of the request if we are updating/creating a value via API
     :return: json of request made
     """
-    headers = {
-        "content-type": "application/json",
-        "DD-API-KEY": dd_api_key,
-        "DD-APPLICATION-KEY": dd_app_key
-    }
-
-    # EU costumers need to define 'api_host' as below
-    if eu_customer == "True":
-        headers["api_host"] = "https://api.datadoghq.eu/"
-
-    try:
-        if method.upper() == "GET":
-            # Make DD API GET request
-            results = requests.get(
-                "https://api.datadoghq.com/api/v1/" + request_path,
-                headers=headers
-                # params=api_params
-            )
-        elif method.upper() == "PUT":
-            if body is None:
-                raise Exception("A valid body is required to make a PUT request. Please try again")
-
-            # Make DD API request
-            results = requests.put(
-                "https://api.datadoghq.com/api/v1/" + request_path,
-                headers=headers,
-                json=body
-            )
-        else:
-            raise Exception("Unsupported API Call type.")
+    client_key = (dd_api_key, dd_app_key, get_site(eu_customer))
 
-        # Raise an error if there was one
-        results.raise_for_status()
-        # If call is successful, return json result
-        return results.json()
-    except requests.exceptions.HTTPError as e:
-        raise Exception("Non-200 response code returned from DD API: {}").with_traceback(e.__traceback__)
+    if client_key not in _CLIENTS:
+        _CLIENTS[client_key] = DatadogClient(dd_api_key, dd_app_key, eu_customer)
 
+    return _CLIENTS[client_key].call(request_path, method, body)
 
-def get_metric_query(query, requests_object):
-    """Parses a query/requests object and provides the actual Datadog query
 
-    :param query: String or Dict, contains query from datadog
-    :param dict requests_object: Contains the request object from datadog (has all queries)
-    :return: The parsed individual query from datadog
+class TagTrie:
+    """Prefix trie of old tags, literal or with wildcards
+
+    The trie is turned into a single regex whose alternatives branch one character at a time, so the regex engine
+    only follows the branches the text actually takes: matching cost grows with the length of the text, not with the
+    number of tags. Longer tags win over their prefixes, and literal characters win over a wildcard at the same
+    position.
     """
-    if not query:
-        return query
 
-    if type(query) is str:
-        if query == "x" or query == "y" or query == "fill" or query == "size":
-            # Query equals either "x" or "y"
-            metric_query = requests_object[query]["q"]
-        else:
-            raise Exception("Unsupported string query. Please add it in.")
-    elif "process_query" in query:
-        metric_query = query["process_query"]["filter_by"]
-    elif query["q"]:
-        metric_query = query["q"]
-    else:
-        raise Exception("Query type not supported")
+    def __init__(self):
+        self.root = {}
+
+    def add(self, tag, value=None):
+        """Adds a tag to the trie
+
+        :param string tag: the tag, where each TAG_WILDCARD stands for one or more tag characters
+        :param value: what resolve returns for the tag
+        """
+        node = self.root
+
+        for character in tag:
+            key = TAG_WILDCARD if character == TAG_WILDCARD else character
+            node = node.setdefault(key, {})
+
+        # None is not a valid key of a trie node (keys are single characters)
+        node[None] = value
+
+    def to_regex(self):
+        """Builds the regex matching any tag of the trie
+
+        :return: regex source string
+        """
+        return self._node_regex(self.root)
+
+    def _node_regex(self, node):
+        alternatives = []
+
+        for character in sorted(key for key in node if key is not None and key != TAG_WILDCARD):
+            child = node[character]
+            branch = re.escape(character)
+
+            # Chains of nodes with a single child are written as plain text rather than one group per character
+            while len(child) == 1 and None not in child and TAG_WILDCARD not in child:
+                character, child = next(iter(child.items()))
+                branch += re.escape(character)
+
+            alternatives.append(branch + self._node_regex(child))
+
+        if TAG_WILDCARD in node:
+            alternatives.append(WILDCARD_CHARACTERS + "+" + self._node_regex(node[TAG_WILDCARD]))
+
+        if not alternatives:
+            return ""
+
+        regex = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+
+        if None in node:
+            # The tag may end here, but a longer one is tried first
+            regex = "(?:" + regex + ")?"
+
+        return regex
 
-    return metric_query
+    def resolve(self, text):
+        """Finds the tag of the trie that text is an occurrence of, taking the branches in the same order as the regex
 
+        :param string text: text matched by the regex of the trie
+        :return: tuple of the value the tag was added with and the list of texts its wildcards stand for, or None
+        """
+        wildcard_pattern = re.compile(WILDCARD_CHARACTERS)
+        stack = [(self.root, 0, [])]
 
-def build_new_request(new_metric_query, query, requests_object, index_counter):
-    """Builds an updated request object with the query containing the new tags
+        while stack:
+            node, position, captures = stack.pop()
 
-    :param string new_metric_query: the metric query containing the new tags
-    :param query: String/Dict containing the current query
-    :param dict requests_object: the original request from dd API
-    :param int index_counter: the index of which this item comes from if it's from an array
-    :return: the updated request response to replace the original
+            if position == len(text):
+                if None in node:
+                    return node[None], captures
+                continue
+
+            # Pushed in reverse order of preference: ending here, the wildcard (shortest first) then the literal
+            if TAG_WILDCARD in node:
+                end = position
+                while end < len(text) and wildcard_pattern.match(text[end]):
+                    end += 1
+                for wildcard_end in range(position + 1, end + 1):
+                    stack.append((node[TAG_WILDCARD], wildcard_end, captures + [text[position:wildcard_end]]))
+
+            child = node.get(text[position])
+            if child is not None:
+                stack.append((child, position + 1, captures))
+
+        return None
+
+
+def _tags_regex(tags):
+    """Regex matching any of the tags, see TagTrie"""
+    trie = TagTrie()
+    for tag in tags:
+        trie.add(tag)
+
+    return trie.to_regex()
+
+
+class TagMatcher:
+    """Compiled form of the configs.json tags map
+
+    Every old tag is folded into a prefix trie (see TagTrie) compiled to a single regex, which lets a query be
+    rewritten in one pass no matter how many tags are configured. Besides literal tags the map can hold pattern rules
+    where each TAG_WILDCARD of the old tag captures one or more tag characters, put back in the same order in place of
+    the wildcards of the new tag:
+
+        "env:*": "environment:*"            renames a tag key and keeps the value
+        "env:dev-*": "env:development-*"    rewrites a value prefix
+        "service:*-legacy": "service:*"    drops part of a value
+
+    Tag list items are only replaced when a whole item is an old tag (or fully matches a pattern rule). In query
+    strings, pattern rules only replace whole tags inside {...} scopes, literal tags are replaced anywhere.
+
+    The map used to be applied one rule after another, so a new tag that is an old tag of a rule listed after it was
+    rewritten again ("team:dev" -> "host:prod" then "host:prod" -> "team:x" turns "team:dev" into "team:x"). The same
+    chains are resolved when the matcher is built, and literal tags mapped back to themselves through a chain are
+    rejected.
+
+    The same query strings show up across many dashboards and monitors, so the outcome of the most recently rewritten
+    queries is kept in a bounded LRU cache shared by every resource type.
     """
-    if not query:
-        return query
 
-    if type(query) is str:
-        if query == "x" or query == "y" or query == "fill" or query == "size":
-            requests_object[query]["q"] = new_metric_query
+    def __init__(self, tags, cache_size=DEFAULT_QUERY_CACHE_SIZE):
+        """
+        :param dict tags: dict where key is a key:value pair for the old tag and the value is a key:value pair of new
+                          tag
+        :param int cache_size: max number of query strings whose rewrite is remembered (0 disables the cache)
+        """
+        self.tags = dict(tags)
+        self.order = {old_tag: index for index, old_tag in enumerate(self.tags)}
+        # Final new tag of each literal tag, in query strings and in tag lists, once chains are followed
+        self.literal_tags = {}
+        self.list_tags = {}
+        self.pattern_rules = {}
+
+        for old_tag, new_tag in self.tags.items():
+            if TAG_WILDCARD not in old_tag:
+                self.list_tags[old_tag] = new_tag
+                continue
+
+            if TAG_WILDCARD * 2 in old_tag or not old_tag.strip(TAG_WILDCARD):
+                raise Exception("Invalid tag rule {}: wildcards have to be separated by some text.".format(old_tag))
+
+            if new_tag.count(TAG_WILDCARD) > old_tag.count(TAG_WILDCARD):
+                raise Exception("Invalid tag rule {}: {} has more wildcards than the old tag.".format(old_tag, new_tag))
+
+            self.pattern_rules[old_tag] = new_tag
+
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self._check_cycles()
+
+        if self.tags:
+            self.trie = TagTrie()
+            for old_tag in self.tags:
+                self.trie.add(old_tag, old_tag)
+
+            # In query strings an old tag listed before another one can also be replaced inside it, so the whole text
+            # of each old tag goes through every rule
+            for old_tag, new_tag in self.list_tags.items():
+                self.literal_tags[old_tag] = self._follow_rules(old_tag, -1, False)
+                self.list_tags[old_tag] = self._follow_rules(new_tag, self.order[old_tag], True)
+
+            tag_regex = self.trie.to_regex()
+            self.full_pattern = re.compile(tag_regex) if self.pattern_rules else None
+
+            if self.pattern_rules:
+                literal_regex = _tags_regex(self.literal_tags)
+                self.pattern = re.compile(r'\b(?:' + literal_regex + r')\b') if literal_regex else None
+                self.scope_pattern = re.compile(
+                    TAG_START + "(?:" + _tags_regex(self.pattern_rules) + ")" + TAG_END
+                    + (r'|\b(?:' + literal_regex + r')\b' if literal_regex else "")
+                )
+            else:
+                self.pattern = re.compile(r'\b(?:' + tag_regex + r')\b')
+                self.scope_pattern = None
+
+            raw_trie = TagTrie()
+            for form in self._raw_forms():
+                raw_trie.add(form)
+            self.raw_pattern = re.compile(raw_trie.to_regex().encode("utf-8"))
         else:
-            raise Exception("Unsupported string query. Please add it in.")
+            self.trie = None
+            self.pattern = None
+            self.scope_pattern = None
+            self.full_pattern = None
+            self.raw_pattern = None
 
-    elif "process_query" in query:
-        requests_object[index_counter]["process_query"]["filter_by"] = new_metric_query
-    elif requests_object[index_counter]["q"]:
-        requests_object[index_counter]['q'] = new_metric_query
-    else:
-        raise Exception("Query type is not currently supported.")
+    def _check_cycles(self):
+        """Rejects literal tags that a chain of rules maps back to a tag already on the chain"""
+        chain_of = {}
+
+        for start in self.list_tags:
+            tag = start
+
+            while tag in self.list_tags and tag not in chain_of:
+                chain_of[tag] = start
+                new_tag = self.list_tags[tag]
+
+                if new_tag == tag:
+                    break
+
+                if chain_of.get(new_tag) == start:
+                    raise Exception("Invalid tag rules: {} is mapped back to itself through {}. Please remove one of "
+                                    "the rules and run again.".format(new_tag, tag))
+
+                tag = new_tag
+
+    def _literal_rules_in(self, text, whole):
+        """Literal old tags found in text: text itself if whole, else every old tag it contains"""
+        if whole:
+            return [text] if text in self.list_tags else []
+
+        rules = []
+        for start in range(len(text)):
+            node = self.trie.root
+
+            for character in text[start:]:
+                node = node.get(character)
+                if node is None:
+                    break
+
+                if node.get(None) in self.list_tags:
+                    rules.append(node[None])
+
+        return rules
+
+    def _follow_rules(self, tag, index, whole):
+        """Applies the literal tags listed after a rule to the new tag it produced, as applying the rules one after
+        another did
+
+        :param string tag: new tag produced by the rule
+        :param int index: position of the rule in the tags map
+        :param bool whole: True for tag list items, which are only replaced when the whole item is an old tag, False
+                           for query strings, where old tags are also replaced inside longer text
+        :return: the final new tag
+        """
+        while True:
+            rules = [rule for rule in self._literal_rules_in(tag, whole) if self.order[rule] > index]
+            if not rules:
+                return tag
+
+            rule = min(rules, key=self.order.get)
+            index = self.order[rule]
+            new_tag = self.tags[rule]
+
+            if whole:
+                tag = new_tag
+            else:
+                tag = re.sub(r'\b' + re.escape(rule) + r'\b', lambda match: new_tag, tag)
+
+    def _raw_forms(self):
+        """Every way an old tag can be spelled inside a raw JSON payload (plain, JSON escaped and '/' escaped)
+
+        Pattern rules are represented by their longest literal part, which has to appear for the rule to match.
+        """
+        forms = set()
+
+        for tag in self.tags:
+            if TAG_WILDCARD in tag:
+                tag = max(tag.split(TAG_WILDCARD), key=len)
+
+            forms.add(tag)
+            escaped = json.dumps(tag)[1:-1]
+            forms.add(escaped)
+            forms.add(escaped.replace("/", "\\/"))
+
+        return forms
+
+    def replace_tag(self, tag, whole=False):
+        """Works out the new tag for an occurrence of an old tag
+
+        :param string tag: text that is exactly an old tag, or fully matches a pattern rule
+        :param bool whole: True if tag is a whole tag list item, False if it was found in a query string
+        :return: the new tag, or None if tag is not an old tag
+        """
+        new_tag = (self.list_tags if whole else self.literal_tags).get(tag)
+        if new_tag is not None or not self.pattern_rules:
+            return new_tag
+
+        resolved = self.trie.resolve(tag)
+        if resolved is None:
+            return None
+
+        old_tag, captures = resolved
+        parts = self.tags[old_tag].split(TAG_WILDCARD)
+        new_tag = parts[0] + "".join(capture + part for capture, part in zip(captures, parts[1:]))
+
+        return self._follow_rules(new_tag, self.order[old_tag], whole)
+
+    def _replace_item(self, item):
+        """New tag for a whole tag list item, or None if the item is not an old tag"""
+        if type(item) is not str:
+            return None
+
+        new_tag = self.list_tags.get(item)
+        if new_tag is not None or self.full_pattern is None:
+            return new_tag
+
+        if self.full_pattern.fullmatch(item) is None:
+            return None
+
+        return self.replace_tag(item, True)
+
+    def search_raw(self, raw):
+        """Cheap check on an undecoded API response for any old tag
+
+        May report a hit that the query rewrite later ignores (e.g. no word boundary), but never misses one, so a
+        payload without a hit can be treated as unchanged without decoding it.
+
+        :param bytes raw: raw JSON bytes returned by the API
+        :return: True if any old tag appears in the payload
+        """
+        if self.raw_pattern is None:
+            return False
+
+        return self.raw_pattern.search(raw) is not None
+
+    def _replace_matches(self, pattern, text):
+        """Replaces every match of pattern in text with its new tag
+
+        A literal tag found inside longer tag text (e.g. "env:dev" in "env:dev-1") rewrites all of that text with the
+        rules in order, which is what applying the rules one after another did to it.
+        """
+        parts = []
+        position = 0
+
+        for match in pattern.finditer(text):
+            start, end = match.span()
+            if start < position:
+                continue
 
-    return requests_object
+            tag = match.group(0)
+            new_tag = self.literal_tags.get(tag)
+
+            if new_tag is not None:
+                while start > position and TAG_CHARACTER.match(text, start - 1):
+                    start -= 1
+                end = TAG_TAIL.match(text, end).end()
+
+                if end - start != len(tag):
+                    new_tag = self._follow_rules(text[start:end], -1, False)
+            else:
+                new_tag = self.replace_tag(tag)
+                if new_tag is None:
+                    continue
+
+            parts.append(text[position:start])
+            parts.append(new_tag)
+            position = end
+
+        if not parts:
+            return text
+
+        parts.append(text[position:])
+        return "".join(parts)
+
+    def _replace_query(self, metric_query):
+        if self.scope_pattern is None:
+            return self._replace_matches(self.pattern, metric_query)
+
+        # Odd parts are the {...} scopes of the query, where pattern rules apply on top of the literal tags
+        parts = SCOPE_PATTERN.split(metric_query)
+
+        for index, part in enumerate(parts):
+            pattern = self.scope_pattern if index % 2 else self.pattern
+            if pattern is not None:
+                parts[index] = self._replace_matches(pattern, part)
+
+        return "".join(parts)
+
+    def replace_string(self, metric_query):
+        """Replaces every old tag found in a string with its new tag
+
+        Literal tags are replaced anywhere in the string, pattern rules only replace whole tags inside the {...}
+        scopes of the query.
+
+        :param string metric_query: the string we want to rewrite
+        :return: tuple of the updated string and True if it differs from the original (a tag mapped to itself, or
+                 to what it already was, is not a change)
+        """
+        if self.pattern is None and self.scope_pattern is None:
+            return metric_query, False
+
+        if not self.cache_size:
+            new_query = self._replace_query(metric_query)
+            return new_query, new_query != metric_query
+
+        # The rewrite itself holds the GIL, so doing it under the lock doesn't cost any parallelism
+        with self.cache_lock:
+            result = self.cache.get(metric_query)
+
+            if result is not None:
+                self.cache.move_to_end(metric_query)
+                self.cache_hits += 1
+                return result
+
+            self.cache_misses += 1
+            new_query = self._replace_query(metric_query)
+            result = self.cache[metric_query] = (new_query, new_query != metric_query)
+
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+            return result
+
+    def cache_info(self):
+        """Hit/miss statistics of the query cache, used to size it
+
+        :return: dict with the 'hits', 'misses', current 'size' and 'max_size' of the cache
+        """
+        with self.cache_lock:
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "size": len(self.cache),
+                "max_size": self.cache_size
+            }
+
+    def matches_list(self, items):
+        """Checks whether replace_list would change anything in a list, without changing it
+
+        :param list items: list of tags
+        :return: True if any item is exactly an old tag
+        """
+        return any(self._replace_item(item) is not None for item in items)
+
+    def replace_list(self, original_list):
+        """Replaces every item of a list that is exactly an old tag with its new tag
+
+        :param list original_list: the list that has the items to be replaced (updated in place)
+        :return: tuple of the updated list and True if it holds different tags than before
+        """
+        replace_tracker = False
+
+        for index, current_string in enumerate(original_list):
+            new_tag = self._replace_item(current_string)
+
+            if new_tag is not None and new_tag != current_string:
+                original_list[index] = new_tag
+                replace_tracker = True
+
+        return original_list, replace_tracker
+
+
+# Last matcher built by compile_tags, reused while the same tags dict keeps being passed in
+_COMPILED_TAGS = None
+
+
+def compile_tags(tags):
+    """Builds a TagMatcher for the tags map, reusing the previous one if it was built from the same dict
+
+    :param tags: dict of old tag -> new tag, or an already compiled TagMatcher
+    :return: TagMatcher for the given tags
+    """
+    global _COMPILED_TAGS
+
+    if isinstance(tags, TagMatcher):
+        return tags
+
+    if _COMPILED_TAGS is None or _COMPILED_TAGS[0] is not tags:
+        _COMPILED_TAGS = (tags, TagMatcher(tags))
+
+    return _COMPILED_TAGS[1]
 
 
 def find_and_replace_tags(metric_query, tags):
     """Goes through every tag and replaces the old one (if present) with the new
 
-    :param string metric_query: the query for which we need to update for the widget
-    :param dict tags: dict where key is a key:value pair for the old tag and the value is a key:value pair of new tag
+    :param metric_query: the query (string) or tag list for which we need to update for the widget
+    :param tags: dict where key is a key:value pair for the old tag and the value is a key:value pair of new tag,
+                 or a TagMatcher already compiled from it
     :return: updated metric query
     """
-    replace_tracker = False
-    for current_tag, new_tag in tags.items():
-        if current_tag in metric_query:
-            if type(metric_query) == list:
-                metric_query, temp_replace_tracker = replace_all(metric_query, current_tag, new_tag)
+    matcher = compile_tags(tags)
+    start = time.perf_counter()
 
-                if not replace_tracker and temp_replace_tracker:
-                    replace_tracker = True
-            else:
-                metric_query, replace_counter = re.subn(r'\b' + current_tag + r'\b', new_tag, metric_query)
-                if not replace_tracker and replace_counter > 0:
-                    replace_tracker = True
+    if type(metric_query) == list:
+        result = matcher.replace_list(metric_query)
+    else:
+        result = matcher.replace_string(metric_query)
+
+    metrics.RUN_STATS.add_time("regex", time.perf_counter() - start)
 
-    return metric_query, replace_tracker
+    return result
 
 
-def replace_all(original_list, current_tag, new_tag):
-    """Helper function that runs regex replace on a list and creates a new list
+def _rewrite_field(container, key, matcher, path, changes):
+    """Rewrites container[key] in place if it is a query string or tag list containing old tags
 
-    :param list original_list: the original list that has the items to be replace
-    :param string current_tag: the current string tag we want to replace
-    :param string new_tag: the new item we want to replace the list items with
-    :returns: updated list with the new items
+    :param dict container: the dict holding the field
+    :param string key: the field name
+    :param TagMatcher matcher: compiled tags map
+    :param string path: JSON path of the container, used to record the change
+    :param list changes: list the (JSON path, old value, new value) of the field is appended to when it changes
     """
-    replace_tracker = False
+    value = container.get(key)
 
-    for index, current_string in enumerate(original_list):
-        if current_tag == current_string:
-            original_list[index], replace_counter = re.subn(r'\b' + current_tag + r'\b', new_tag, current_string)
+    if not value:
+        return
 
-            if not replace_tracker and replace_counter > 0:
-                replace_tracker = True
+    start = time.perf_counter()
+
+    if type(value) is list:
+        # replace_list works in place, keep the original items for the diff
+        old_value = list(value)
+        new_value, replace_tracker = matcher.replace_list(value)
+    elif type(value) is str:
+        old_value = value
+        new_value, replace_tracker = matcher.replace_string(value)
+    else:
+        return
+
+    metrics.RUN_STATS.add_time("regex", time.perf_counter() - start)
+
+    if replace_tracker:
+        container[key] = new_value
+        changes.append(("{}.{}".format(path, key), old_value, new_value))
+
+
+def rewrite_widgets(widgets, tags, path="widgets"):
+    """Walks every widget of a dashboard (including groups nested at any depth) and replaces the tags in every
+    query-bearing field
+
+    Visits the 'q' of classic requests (list or x/y/fill/size style), process query filters, formula 'queries',
+    'metadata' expressions and the widget level 'query'/'filters' fields.
+
+    :param list widgets: the "widgets" section of a dashboard config (updated in place)
+    :param tags: dict of old tag -> new tag, or a TagMatcher already compiled from it
+    :param string path: JSON path of the widgets list
+    :return: list of (JSON path, old value, new value) of the fields that were changed
+    """
+    matcher = compile_tags(tags)
+    changes = []
+
+    # Pushed in reverse so widgets are visited in dashboard order
+    stack = [("{}[{}]".format(path, index), widget) for index, widget in reversed(list(enumerate(widgets)))]
+
+    while stack:
+        widget_path, widget = stack.pop()
+        definition = widget.get("definition")
+
+        if not definition or definition.get("type") in UNSUPPORTED_WIDGET_TYPES:
+            continue
+
+        definition_path = widget_path + ".definition"
+
+        # Response: {'definition': {'widgets': [{'definition':..., 'requests': [{'q':...}] }] }}
+        child_widgets = definition.get("widgets") or []
+        for index, child_widget in reversed(list(enumerate(child_widgets))):
+            stack.append(("{}.widgets[{}]".format(definition_path, index), child_widget))
+
+        # Response: {'definition': {'query':..., }} or {'definition': {'filters':..., }}
+        _rewrite_field(definition, "query", matcher, definition_path, changes)
+        _rewrite_field(definition, "filters", matcher, definition_path, changes)
+
+        # Response: {'definition': {'requests': [{'q':...}, ...] }} or {'definition': {'requests': {'x': {'q':...}} }}
+        requests_object = definition.get("requests")
+        if type(requests_object) is dict:
+            request_items = [("{}.requests.{}".format(definition_path, key), request)
+                             for key, request in requests_object.items()]
+        elif type(requests_object) is list:
+            request_items = [("{}.requests[{}]".format(definition_path, index), request)
+                             for index, request in enumerate(requests_object)]
+        else:
+            request_items = []
+
+        for request_path, request in request_items:
+            # Ignore the following queries: logs, apm, network, and rum
+            if type(request) is not dict or any(key in request for key in IGNORED_QUERY_KEYS):
+                continue
+
+            _rewrite_field(request, "q", matcher, request_path, changes)
+
+            process_query = request.get("process_query")
+            if process_query:
+                _rewrite_field(process_query, "filter_by", matcher, request_path + ".process_query", changes)
 
-    return original_list, replace_tracker
+            # Formula requests: {'queries': [{'data_source': 'metrics', 'query': ...}], 'formulas': [...]}
+            # (formulas only reference queries by name so there is nothing to rewrite in them)
+            for index, formula_query in enumerate(request.get("queries") or []):
+                query_path = "{}.queries[{}]".format(request_path, index)
+                data_source = formula_query.get("data_source", "metrics")
+
+                if data_source in METRIC_DATA_SOURCES:
+                    _rewrite_field(formula_query, "query", matcher, query_path, changes)
+                elif data_source == "process":
+                    _rewrite_field(formula_query, "tag_filters", matcher, query_path, changes)
+
+            for index, metadata in enumerate(request.get("metadata") or []):
+                _rewrite_field(metadata, "expression", matcher, "{}.metadata[{}]".format(request_path, index),
+                               changes)
+
+    return changes
 
 
 def cleanup_dashboard_json(dashboard_config):
@@ -223,3 +1348,44 @@ def cleanup_synthetic_json(synthetic_config):
             pass
 
     return synthetic_config
+
+
+def host_tags_path(host_name):
+    """Builds the API path of the user tags of a host
+
+    :param string host_name: name of the host
+    :return: API path of the tags of the host
+    """
+    return "tags/hosts/{}?source={}".format(urllib.parse.quote(host_name, safe=""), HOST_TAGS_SOURCE)
+
+
+def host_tags_version(host_tags):
+    """Fingerprint of the tags of a host, stands in for the modified_at hosts don't have
+
+    :param list host_tags: tags of the host
+    :return: hex digest of the tags, whatever their order
+    """
+    return hashlib.sha1(json.dumps(sorted(host_tags)).encode("utf-8")).hexdigest()[:16]
+
+
+def resource_version(resource_type, config):
+    """Version of a resource as returned by a GET or PUT of it: its last modification time, or the fingerprint of the
+    tags of a host
+
+    :param string resource_type: dashboard/monitor/synthetic/host
+    :param dict config: the resource
+    :return: version of the resource, compared to tell whether it changed
+    """
+    if resource_type == "host":
+        return host_tags_version(config.get("tags") or [])
+
+    return config.get(MODIFIED_KEYS[resource_type])
+
+
+def cleanup_host_tags_json(host_tags_config):
+    """Helper function that only keeps the fields the host tags endpoint accepts
+
+    :param host_tags_config: Json of the tags of a host
+    :return: Json with the host and its tags
+    """
+    return {key: host_tags_config[key] for key in ("host", "tags") if key in host_tags_config}
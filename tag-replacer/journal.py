@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import threading
+
+# Outcomes recorded for a resource
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+ERROR = "error"
+
+
+def hash_tags(tags):
+    """Builds a short fingerprint of the tags map so journal entries from a different map are not reused
+
+    :param dict tags: dict where key is a key:value pair for the old tag and the value is a key:value pair of new tag
+    :return: hex digest of the tags map
+    """
+    return hashlib.sha1(json.dumps(tags, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class Journal:
+    """Append-only progress journal for replacer runs
+
+    Every processed resource gets one JSON line with its type, id, outcome and the modified_at seen when it was
+    processed. When a run is restarted, resources that were already updated, or that were found unchanged and have
+    not been modified since, can be skipped without fetching them again. Entries written for a different tags map
+    are ignored.
+    """
+
+    def __init__(self, path, tags):
+        """
+        :param string path: path of the journal file (created if it doesn't exist)
+        :param dict tags: the tags map of the current run
+        """
+        self.path = path
+        self.tags_hash = hash_tags(tags)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line may be partially written if the previous run was killed
+                        continue
+
+                    self.entries[(entry["type"], entry["id"])] = entry
+
+        self.journal_file = open(path, "a")
+
+    def is_done(self, resource_type, resource_id, modified_at):
+        """Checks whether a resource was already handled by a previous run with the same tags map
+
+        :param string resource_type: dashboard/monitor/synthetic
+        :param resource_id: id of the resource
+        :param string modified_at: last modification time reported by the list endpoint
+        :return: True if the resource can be skipped
+        """
+        entry = self.entries.get((resource_type, str(resource_id)))
+
+        if entry is None or entry["tags"] != self.tags_hash:
+            return False
+
+        if entry["outcome"] == UPDATED:
+            return True
+
+        return entry["outcome"] == UNCHANGED and modified_at is not None and entry["modified_at"] == modified_at
+
+    def record(self, resource_type, resource_id, outcome, modified_at=None):
+        """Appends the outcome for a resource to the journal
+
+        :param string resource_type: dashboard/monitor/synthetic
+        :param resource_id: id of the resource
+        :param string outcome: one of UPDATED, UNCHANGED or ERROR
+        :param string modified_at: last modification time reported by the list endpoint
+        :return:
+        """
+        entry = {
+            "type": resource_type,
+            "id": str(resource_id),
+            "outcome": outcome,
+            "modified_at": modified_at,
+            "tags": self.tags_hash
+        }
+
+        with self.lock:
+            self.entries[(resource_type, entry["id"])] = entry
+            self.journal_file.write(json.dumps(entry) + "\n")
+            self.journal_file.flush()
+
+    def close(self):
+        self.journal_file.close()
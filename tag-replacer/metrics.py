@@ -0,0 +1,284 @@
+import collections
+import socket
+import threading
+import time
+
+DEFAULT_DOGSTATSD_PORT = 8125
+
+# Prefix of every metric sent to DogStatsD
+METRIC_PREFIX = "tag_replacer."
+
+# Largest DogStatsD datagram sent, metrics are split over several datagrams above it
+MAX_DATAGRAM_SIZE = 8192
+
+
+def endpoint_name(request_path):
+    """Collapses resource ids out of an API path so calls can be grouped per endpoint
+
+    :param string request_path: path of the call (e.g. dashboard/abc-def-ghi)
+    :return: endpoint name (e.g. dashboard/{id})
+    """
+    parts = request_path.split("?")[0].split("/")
+
+    if parts[0] in ("dashboard", "monitor"):
+        return parts[0] if len(parts) == 1 else parts[0] + "/{id}"
+
+    if len(parts) <= 2:
+        return "/".join(parts)
+
+    return "/".join(parts[:-1]) + "/{id}"
+
+
+class RunStats:
+    """Timings and counters collected during a replacer run
+
+    Each thread adds to its own set of totals so the rewrite loop never waits on a lock; the totals of every thread
+    are only added up when the summary is built.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.shards = []
+        self.gauges = {}
+
+    def _shard(self):
+        shard = getattr(self.local, "shard", None)
+
+        if shard is None:
+            shard = {
+                "phases": collections.defaultdict(float),
+                "phase_counts": collections.Counter(),
+                "counters": collections.Counter(),
+                "calls": {}
+            }
+            self.local.shard = shard
+
+            with self.lock:
+                self.shards.append(shard)
+
+        return shard
+
+    def add_time(self, phase, seconds):
+        """Adds the time spent in one occurrence of a phase
+
+        :param string phase: name of the phase (fetch, prefilter, decode, rewrite, regex, cleanup, write...)
+        :param float seconds: time spent
+        """
+        shard = self._shard()
+        shard["phases"][phase] += seconds
+        shard["phase_counts"][phase] += 1
+
+    def timer(self, phase):
+        """Context manager adding the time spent in its block to a phase"""
+        return _PhaseTimer(self, phase)
+
+    def increment(self, counter, value=1):
+        """Increments a named counter (e.g. dashboard.changed)"""
+        self._shard()["counters"][counter] += value
+
+    def gauge(self, name, value):
+        """Sets a value measured at one point in time (e.g. query_cache.size), the last one set is reported"""
+        with self.lock:
+            self.gauges[name] = value
+
+    def add_bytes_in(self, method, request_path, bytes_in):
+        """Adds response bytes read after the call was recorded, for bodies streamed to the caller
+
+        :param string method: HTTP method of the call
+        :param string request_path: path of the call
+        :param int bytes_in: number of bytes of the body read
+        """
+        key = (method, endpoint_name(request_path))
+        calls = self._shard()["calls"]
+
+        call = calls.get(key)
+        if call is None:
+            call = calls[key] = {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes_in": 0, "bytes_out": 0,
+                                 "retries": 0, "errors": 0}
+
+        call["bytes_in"] += bytes_in
+
+    def record_call(self, method, request_path, seconds, status, bytes_in=0, bytes_out=0, retries=0):
+        """Records one API call, retries included
+
+        :param string method: HTTP method of the call
+        :param string request_path: path of the call
+        :param float seconds: time from the first attempt to the final response
+        :param int status: status code of the final response (0 if the API could not be reached)
+        :param int bytes_in: size of the response body
+        :param int bytes_out: size of the request body
+        :param int retries: number of attempts that were retried
+        """
+        key = (method, endpoint_name(request_path))
+        calls = self._shard()["calls"]
+
+        call = calls.get(key)
+        if call is None:
+            call = calls[key] = {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes_in": 0, "bytes_out": 0,
+                                 "retries": 0, "errors": 0}
+
+        call["count"] += 1
+        call["seconds"] += seconds
+        call["max_seconds"] = max(call["max_seconds"], seconds)
+        call["bytes_in"] += bytes_in
+        call["bytes_out"] += bytes_out
+        call["retries"] += retries
+
+        if status == 0 or status >= 400:
+            call["errors"] += 1
+
+    def totals(self):
+        """Adds up the totals of every thread
+
+        :return: dict with the 'elapsed' seconds, the 'phases' (phase -> (seconds, count)), the 'counters', the
+                 'gauges' and the 'calls' ((method, endpoint) -> call totals)
+        """
+        phases = collections.defaultdict(float)
+        phase_counts = collections.Counter()
+        counters = collections.Counter()
+        calls = {}
+
+        with self.lock:
+            shards = list(self.shards)
+            gauges = dict(self.gauges)
+
+        for shard in shards:
+            for phase, seconds in list(shard["phases"].items()):
+                phases[phase] += seconds
+            phase_counts.update(shard["phase_counts"])
+            counters.update(shard["counters"])
+
+            for key, call in list(shard["calls"].items()):
+                if key not in calls:
+                    calls[key] = dict(call)
+                    continue
+
+                total = calls[key]
+                for field, value in call.items():
+                    total[field] = max(total[field], value) if field == "max_seconds" else total[field] + value
+
+        return {
+            "elapsed": time.perf_counter() - self.started,
+            "phases": {phase: (seconds, phase_counts[phase]) for phase, seconds in phases.items()},
+            "counters": dict(counters),
+            "gauges": gauges,
+            "calls": calls
+        }
+
+    def report(self):
+        """Prints a summary of where the time of the run went"""
+        totals = self.totals()
+
+        print("** RUN STATS **")
+        print("Elapsed: {:.2f}s".format(totals["elapsed"]))
+
+        if totals["phases"]:
+            # Phases overlap when several resources are processed at the same time, so they can add up to more
+            # than the elapsed time
+            print("Time per phase (summed over workers):")
+            for phase, (seconds, count) in sorted(totals["phases"].items(), key=lambda item: -item[1][0]):
+                print("  {}: {:.3f}s over {} call(s)".format(phase, seconds, count))
+
+        if totals["calls"]:
+            print("API calls:")
+            for (method, endpoint), call in sorted(totals["calls"].items()):
+                print("  {} {}: {} call(s), avg {:.1f}ms, max {:.1f}ms, {} retried, {} failed, {} B in, {} B out"
+                      .format(method, endpoint, call["count"], call["seconds"] / call["count"] * 1000,
+                              call["max_seconds"] * 1000, call["retries"], call["errors"], call["bytes_in"],
+                              call["bytes_out"]))
+
+        if totals["counters"]:
+            print("Counters:")
+            for counter, value in sorted(totals["counters"].items()):
+                print("  {}: {}".format(counter, value))
+
+        if totals["gauges"]:
+            print("Gauges:")
+            for gauge, value in sorted(totals["gauges"].items()):
+                print("  {}: {}".format(gauge, value))
+
+    def send_dogstatsd(self, host="localhost", port=DEFAULT_DOGSTATSD_PORT, tags=None):
+        """Sends the totals of the run to a DogStatsD agent over UDP
+
+        Phases and gauges are sent as gauges (phases in seconds), counters and API calls as counts. Sending is best
+        effort: UDP never blocks the run on the agent and a missing agent only loses the metrics.
+
+        :param string host: host of the agent
+        :param int port: DogStatsD port of the agent
+        :param list tags: tags added to every metric (e.g. ["run_mode:prod"])
+        """
+        totals = self.totals()
+        lines = ["{}elapsed:{:.3f}|g{}".format(METRIC_PREFIX, totals["elapsed"], _format_tags(tags))]
+
+        for phase, (seconds, count) in totals["phases"].items():
+            phase_tags = _format_tags(tags, ["phase:" + phase])
+            lines.append("{}phase.seconds:{:.6f}|g{}".format(METRIC_PREFIX, seconds, phase_tags))
+            lines.append("{}phase.count:{}|c{}".format(METRIC_PREFIX, count, phase_tags))
+
+        for counter, value in totals["counters"].items():
+            lines.append("{}{}:{}|c{}".format(METRIC_PREFIX, counter, value, _format_tags(tags)))
+
+        for gauge, value in totals["gauges"].items():
+            lines.append("{}{}:{}|g{}".format(METRIC_PREFIX, gauge, value, _format_tags(tags)))
+
+        for (method, endpoint), call in totals["calls"].items():
+            call_tags = _format_tags(tags, ["method:" + method, "endpoint:" + endpoint])
+            lines.append("{}api.calls:{}|c{}".format(METRIC_PREFIX, call["count"], call_tags))
+            lines.append("{}api.seconds:{:.6f}|g{}".format(METRIC_PREFIX, call["seconds"], call_tags))
+            lines.append("{}api.max_seconds:{:.6f}|g{}".format(METRIC_PREFIX, call["max_seconds"], call_tags))
+            lines.append("{}api.retries:{}|c{}".format(METRIC_PREFIX, call["retries"], call_tags))
+            lines.append("{}api.errors:{}|c{}".format(METRIC_PREFIX, call["errors"], call_tags))
+            lines.append("{}api.bytes_in:{}|c{}".format(METRIC_PREFIX, call["bytes_in"], call_tags))
+            lines.append("{}api.bytes_out:{}|c{}".format(METRIC_PREFIX, call["bytes_out"], call_tags))
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for datagram in _pack_datagrams(lines):
+                try:
+                    sock.sendto(datagram, (host, port))
+                except OSError:
+                    pass
+        finally:
+            sock.close()
+
+
+class _PhaseTimer:
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.stats.add_time(self.phase, time.perf_counter() - self.start)
+
+
+def _format_tags(tags, extra_tags=None):
+    all_tags = list(tags or []) + list(extra_tags or [])
+    return "|#" + ",".join(all_tags) if all_tags else ""
+
+
+def _pack_datagrams(lines):
+    """Groups metric lines into newline separated datagrams no bigger than MAX_DATAGRAM_SIZE"""
+    datagram = b""
+
+    for line in lines:
+        encoded = line.encode("utf-8")
+
+        if datagram and len(datagram) + len(encoded) + 1 > MAX_DATAGRAM_SIZE:
+            yield datagram
+            datagram = b""
+
+        datagram = datagram + b"\n" + encoded if datagram else encoded
+
+    if datagram:
+        yield datagram
+
+
+# Stats of the current run, shared by the API clients and the replacer
+RUN_STATS = RunStats()
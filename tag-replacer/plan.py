@@ -0,0 +1,168 @@
+import gzip
+import json
+import threading
+import helpers
+import journal as progress_journal
+from concurrent.futures import ThreadPoolExecutor
+
+# Outcomes of applying a single plan entry
+APPLIED = "applied"
+CONFLICT = "conflict"
+
+
+class PlanWriter:
+    """Writes the changes computed by a plan run to a gzip compressed file, one change per line
+
+    Each line holds the resource type, id, API path and the modified_at seen when the change was computed as JSON,
+    then a tab and the rewritten (already cleaned up) body as JSON, which is everything an apply run needs to push
+    the change. Keeping the body apart lets apply send it as is, without decoding and encoding it again.
+    """
+
+    def __init__(self, path):
+        """
+        :param string path: path of the plan file (overwritten if it exists)
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.plan_file = gzip.open(path, "wb")
+
+    def add(self, resource_type, resource_id, path, modified_at, body):
+        """Adds the rewritten body of a resource to the plan
+
+        :param string resource_type: dashboard/monitor/synthetic
+        :param resource_id: id of the resource
+        :param string path: API path used to PUT the resource
+        :param string modified_at: last modification time of the resource the change was computed from
+        :param dict body: rewritten config of the resource
+        :return:
+        """
+        entry = {
+            "type": resource_type,
+            "id": resource_id,
+            "path": path,
+            "modified_at": modified_at
+        }
+        # Compact JSON never contains a raw tab, so the tab can't be confused with the content of either part
+        line = helpers.json_dumps(entry) + b"\t" + helpers.json_dumps(body) + b"\n"
+
+        with self.lock:
+            self.plan_file.write(line)
+
+    def close(self):
+        self.plan_file.close()
+
+
+def read_plan(path):
+    """Reads a plan file one entry at a time
+
+    :param string path: path of the plan file
+    :return: generator of plan entries, whose 'body' holds the encoded JSON of the change
+    """
+    with gzip.open(path, "rb") as plan_file:
+        for line in plan_file:
+            line = line.rstrip(b"\n")
+            if not line.strip():
+                continue
+
+            header, tab, body = line.partition(b"\t")
+
+            if not tab:
+                # Plan written before bodies were kept apart, the body is part of the entry
+                entry = json.loads(line)
+                entry["body"] = helpers.json_dumps(entry["body"])
+                yield entry
+                continue
+
+            entry = json.loads(header)
+            entry["body"] = body
+            yield entry
+
+
+def apply_entry(client, entry, dashboard_modified, snapshots=None):
+    """PUTs a planned change if the resource has not been modified since the plan was made
+
+    :param helpers.DatadogClient client: client used to call the API
+    :param dict entry: plan entry
+    :param dict dashboard_modified: dashboard id -> current modified_at, from the dashboard list
+    :param snapshot.SnapshotRun snapshots: where the current resource is saved before it is overwritten, or None
+    :return: APPLIED, or CONFLICT if the resource changed since the plan was made
+    """
+    original = None
+
+    if entry["type"] == "dashboard" and snapshots is None:
+        current_modified_at = dashboard_modified.get(entry["id"])
+    else:
+        # The resource is read anyway when it has to be saved, so dashboards are checked against it too
+        original = client.get_raw(entry["path"])
+
+        # Hosts have no modification time, their tags are compared instead
+        current_modified_at = helpers.resource_version(entry["type"], helpers.json_loads(original))
+
+    if current_modified_at != entry["modified_at"]:
+        return CONFLICT
+
+    if snapshots is not None:
+        snapshots.save(entry["type"], entry["id"], entry["path"], original, current_modified_at)
+
+    response = client.request(entry["path"], "PUT", entry["body"])
+
+    if snapshots is not None:
+        snapshots.written(entry["type"], entry["id"], response.content)
+
+    return APPLIED
+
+
+def apply_plan(client, path, concurrency, journal=None, snapshots=None):
+    """Pushes every change of a plan file to the API without re-reading the rest of the account
+
+    Dashboards are checked against a single call to the dashboard list, monitors, synthetics and host tags with a GET
+    of the resource itself. Changes are applied by a pool of workers while the plan is still being read so only a
+    bounded number of bodies is held in memory.
+
+    :param helpers.DatadogClient client: client used to call the API
+    :param string path: path of the plan file
+    :param int concurrency: max number of changes applied at the same time
+    :param journal.Journal journal: progress journal used to skip changes already applied by a previous apply run
+    :param snapshot.SnapshotRun snapshots: where resources are saved before being overwritten, or None
+    :return: dict with the 'applied', 'conflicts' and 'skipped' (type, id) lists and the 'errors' dict
+    """
+    results = {"applied": [], "conflicts": [], "skipped": [], "errors": {}}
+    dashboard_modified = None
+
+    def entries():
+        nonlocal dashboard_modified
+
+        for entry in read_plan(path):
+            if journal and journal.is_done(entry["type"], entry["id"], entry["modified_at"]):
+                results["skipped"].append((entry["type"], entry["id"]))
+                continue
+
+            if entry["type"] == "dashboard" and dashboard_modified is None and snapshots is None:
+                dashboard_modified = {
+                    dashboard["id"]: dashboard.get("modified_at")
+                    for dashboard in client.call("dashboard")["dashboards"]
+                }
+
+            yield entry
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = helpers.iter_bounded(
+            executor,
+            entries(),
+            lambda entry: apply_entry(client, entry, dashboard_modified, snapshots),
+            concurrency * 2
+        )
+
+        for entry, outcome, error in outcomes:
+            key = (entry["type"], entry["id"])
+
+            if error is not None:
+                results["errors"][key] = error
+            elif outcome == APPLIED:
+                results["applied"].append(key)
+                if journal:
+                    journal.record(entry["type"], entry["id"], progress_journal.UPDATED, entry["modified_at"])
+            else:
+                results["conflicts"].append(key)
+
+    return results
@@ -1,221 +1,540 @@
 import requests
+import asyncio
+import contextlib
+import io
 import os
 import json
+import cache as definition_cache
 import helpers
+import journal as progress_journal
+import metrics
+import plan as replacement_plan
+import snapshot as snapshot_store
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
 
-UNSUPPORTED_TYPES = {
-    "alert_value",
-    "check_status",
-    "alert_graph",
-    "slo",
-    "image",
-    "trace_service",
-    "free_text",
-    "iframe"
+# Number of resources processed at the same time unless CONCURRENCY is set
+DEFAULT_CONCURRENCY = 8
+
+DEFAULT_PLAN_FILE = "replacer_plan.jsonl.gz"
+
+DEFAULT_CONFIGS_FILE = "configs.json"
+
+# Run modes that only report the resources that would be updated
+REPORT_MODES = ("test", "plan")
+
+# Print the old and new value of every field that would change in test and plan runs (set in __main__)
+REPORT_DIFF = False
+
+# Order in which resource types are processed and reported
+RESOURCE_TYPES = ("dashboard", "monitor", "synthetic", "host")
+
+# Resource types only processed when configs.json lists them
+OPT_IN_RESOURCE_TYPES = ("host",)
+
+# Removes the read-only fields of each resource type before it is written back
+CLEANUP_FUNCTIONS = {
+    "dashboard": helpers.cleanup_dashboard_json,
+    "monitor": helpers.cleanup_monitor_json,
+    "synthetic": helpers.cleanup_synthetic_json,
+    "host": helpers.cleanup_host_tags_json
 }
 
 
-def update_dashboards(dd_api_key, dd_app_key, eu_customer, tags, config_dashboard_list=None):
+def report_errors(resource_type, errors):
+    """Prints the resources that failed during a run along with the error raised for each
+
+    :param string resource_type: name of the resource type (dashboard/monitor/synthetic)
+    :param dict errors: resource id -> exception raised while processing it
+    :return:
+    """
+    if not errors:
+        return
+
+    print("Failed to process {} {}(s):".format(len(errors), resource_type))
+    for resource_id, error in errors.items():
+        print("  {}: {}".format(resource_id, error))
+
+
+def record_outcome(journal, resource_type, resource_id, changes, modified_at):
+    """Records in the journal (if one is used) and in the run stats how a resource was handled
+
+    Resources that only would have been updated (test mode) are not recorded so they are picked up again later.
+
+    :param journal.Journal journal: progress journal of the run, or None
+    :param string resource_type: dashboard/monitor/synthetic
+    :param resource_id: id of the resource
+    :param list changes: (field, old value, new value) of every field where tags were replaced
+    :param string modified_at: last modification time reported by the list endpoint
+    :return:
+    """
+    metrics.RUN_STATS.increment(resource_type + ".processed")
+    if changes:
+        metrics.RUN_STATS.increment(resource_type + ".changed")
+        metrics.RUN_STATS.increment(resource_type + ".fields_changed", len(changes))
+
+    if journal is None:
+        return
+
+    if not changes:
+        journal.record(resource_type, resource_id, progress_journal.UNCHANGED, modified_at)
+    elif RUN_MODE == "prod":
+        journal.record(resource_type, resource_id, progress_journal.UPDATED, modified_at)
+
+
+def collect_outcome(results, journal, resource_type, resource_id, modified_at, changes=None, error=None):
+    """Records the outcome of a resource in the results of the run and in the journal as soon as it is known
+
+    :param dict results: results of the resource type (see new_results)
+    :param journal.Journal journal: progress journal of the run, or None
+    :param string resource_type: dashboard/monitor/synthetic/host
+    :param resource_id: id of the resource
+    :param string modified_at: last modification time reported by the list endpoint
+    :param list changes: (field, old value, new value) of every field where tags were replaced
+    :param Exception error: exception raised while processing the resource, or None
+    :return:
+    """
+    if error is not None:
+        results["errors"][resource_id] = error
+        if journal:
+            journal.record(resource_type, resource_id, progress_journal.ERROR)
+        return
+
+    record_outcome(journal, resource_type, resource_id, changes, modified_at)
+    add_update(results, resource_id, changes)
+
+
+def prepare_write(resource_type, resource_id, path, config, modified_at, plan=None):
+    """Cleans up a rewritten resource and works out whether it has to be PUT
+
+    In plan mode the change is added to the plan instead, in test mode nothing is done.
+
+    :param string resource_type: dashboard/monitor/synthetic
+    :param resource_id: id of the resource
+    :param string path: API path of the resource
+    :param dict config: rewritten config of the resource
+    :param string modified_at: last modification time of the resource the config was read from
+    :param plan.PlanWriter plan: plan the change is added to when running in plan mode
+    :return: the body to PUT, or None if nothing has to be sent
+    """
+    if RUN_MODE not in ("prod", "plan"):
+        return None
+
+    # Clean up JSON body
+    with metrics.RUN_STATS.timer("cleanup"):
+        config = CLEANUP_FUNCTIONS[resource_type](config)
+
+    if RUN_MODE == "plan":
+        with metrics.RUN_STATS.timer("plan"):
+            plan.add(resource_type, resource_id, path, modified_at, config)
+        return None
+
+    return config
+
+
+def write_back(client, resource_type, resource_id, path, config, modified_at, plan=None, snapshots=None,
+               original=None):
+    """Cleans up a rewritten resource then PUTs it (prod mode) or adds it to the plan (plan mode)
+
+    :param helpers.DatadogClient client: client used to call the API
+    :param string resource_type: dashboard/monitor/synthetic
+    :param resource_id: id of the resource
+    :param string path: API path of the resource
+    :param dict config: rewritten config of the resource
+    :param string modified_at: last modification time of the resource the config was read from
+    :param plan.PlanWriter plan: plan the change is added to when running in plan mode
+    :param snapshot.SnapshotRun snapshots: where the original is saved before it is overwritten, or None
+    :param bytes original: JSON bytes of the resource before its tags were replaced
+    :return:
+    """
+    body = prepare_write(resource_type, resource_id, path, config, modified_at, plan)
+
+    if body is not None and snapshots is not None:
+        with metrics.RUN_STATS.timer("snapshot"):
+            snapshots.save(resource_type, resource_id, path, original, modified_at)
+
+    if body is not None:
+        # The response is only decoded to record the version written, which rollback checks before restoring
+        with metrics.RUN_STATS.timer("write"):
+            response = client.request(path, "PUT", body)
+
+        if snapshots is not None:
+            with metrics.RUN_STATS.timer("snapshot"):
+                snapshots.written(resource_type, resource_id, response.content)
+
+
+async def write_back_async(client, resource_type, resource_id, path, config, modified_at, plan=None, snapshots=None,
+                           original=None):
+    """asyncio counterpart of write_back
+
+    :param helpers.AsyncDatadogClient client: client used to call the API
+    :return:
+    """
+    body = prepare_write(resource_type, resource_id, path, config, modified_at, plan)
+
+    if body is not None and snapshots is not None:
+        with metrics.RUN_STATS.timer("snapshot"):
+            snapshots.save(resource_type, resource_id, path, original, modified_at)
+
+    if body is not None:
+        with metrics.RUN_STATS.timer("write"):
+            content = await client.request(path, "PUT", body)
+
+        if snapshots is not None:
+            with metrics.RUN_STATS.timer("snapshot"):
+                snapshots.written(resource_type, resource_id, content)
+
+
+def report_skipped(resource_type, skipped_count):
+    """Prints how many resources were skipped because a previous run already handled them"""
+    if skipped_count:
+        print("Skipped {} {}(s) already handled in a previous run.".format(skipped_count, resource_type))
+
+
+def new_results():
+    """Results of processing one resource type: ids updated (or to update), their changes by id, count skipped and
+    errors by id"""
+    return {"updated": set(), "changes": {}, "skipped": 0, "errors": {}}
+
+
+def add_update(results, resource_id, changes):
+    """Lists a resource in the report of a test or plan run along with the fields that would change"""
+    if changes and RUN_MODE in REPORT_MODES:
+        results["updated"].add(resource_id)
+
+        if REPORT_DIFF:
+            results["changes"][resource_id] = changes
+
+
+def report_changes(changes):
+    """Prints the fields of each resource that would change, with their old and new value
+
+    :param dict changes: resource id -> list of (field, old value, new value)
+    :return:
+    """
+    for resource_id, resource_changes in changes.items():
+        print("{}:".format(resource_id))
+        for field, old_value, new_value in resource_changes:
+            print("  {}: {} -> {}".format(field, json.dumps(old_value), json.dumps(new_value)))
+
+
+def report(resource_type, results):
+    """Prints the outcome of processing one resource type
+
+    :param string resource_type: dashboard/monitor/synthetic
+    :param dict results: results built by the update function of the resource type
+    :return:
+    """
+    if RUN_MODE in REPORT_MODES:
+        print("** {}S **".format(resource_type.upper()))
+        print("Script will update {} {}(s).".format(len(results["updated"]), resource_type))
+        print(*results["updated"], sep=", ")
+        report_changes(results["changes"])
+
+    metrics.RUN_STATS.increment(resource_type + ".skipped", results["skipped"])
+    metrics.RUN_STATS.increment(resource_type + ".errors", len(results["errors"]))
+
+    report_skipped(resource_type, results["skipped"])
+    report_errors(resource_type, results["errors"])
+
+
+def rewrite_dashboard(raw_config, tags):
+    """Replaces the tags in a dashboard definition
+
+    :param bytes raw_config: dashboard definition as returned by the API
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :return: tuple of the rewritten dashboard config (None if untouched) and the (JSON path, old value, new value)
+             of the fields that were changed
+    """
+    # Dashboards that don't mention any old tag are left untouched without decoding or walking them
+    with metrics.RUN_STATS.timer("prefilter"):
+        if not helpers.compile_tags(tags).search_raw(raw_config):
+            return None, []
+
+    metrics.RUN_STATS.increment("dashboard.matched")
+
+    with metrics.RUN_STATS.timer("decode"):
+        dashboard_config = helpers.json_loads(raw_config)
+
+    # Replace the tags in every widget, nested groups included
+    with metrics.RUN_STATS.timer("rewrite"):
+        changes = helpers.rewrite_widgets(dashboard_config["widgets"], tags)
+
+    return dashboard_config, changes
+
+
+def rewrite_monitor(monitor, tags):
+    """Replaces the tags in the query and tags of a monitor
+
+    :param dict monitor: monitor config (updated in place)
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :return: list of (field, old value, new value) of the fields that were changed
+    """
+    changes = []
+    matcher = helpers.compile_tags(tags)
+
+    # Counted the same way as dashboards: the monitor mentions an old tag, whether or not replacing it changes anything
+    if (monitor["query"] and matcher.search_raw(monitor["query"].encode("utf-8"))) \
+            or matcher.matches_list(monitor["tags"] or []):
+        metrics.RUN_STATS.increment("monitor.matched")
+
+    # Grab the query from monitor response and replace accordingly
+    monitor_query = monitor["query"]
+    if monitor_query:
+        monitor["query"], replace_tracker = helpers.find_and_replace_tags(monitor_query, tags)
+
+        if replace_tracker:
+            changes.append(("query", monitor_query, monitor["query"]))
+
+    # Grab the tags from monitor response and replace accordingly
+    monitor_tags = monitor["tags"]
+    if monitor_tags:
+        # The tags are replaced in place, keep the original ones for the diff
+        old_tags = list(monitor_tags)
+        monitor["tags"], replace_tracker = helpers.find_and_replace_tags(monitor_tags, tags)
+
+        if replace_tracker:
+            changes.append(("tags", old_tags, monitor["tags"]))
+
+    return changes
+
+
+def rewrite_synthetic(synthetic_config, tags):
+    """Replaces the tags of a synthetic
+
+    :param dict synthetic_config: synthetic config (updated in place)
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :return: list of (field, old value, new value) of the fields that were changed
+    """
+    old_tags = list(synthetic_config["tags"])
+    synthetic_config["tags"], replace_tracker = helpers.find_and_replace_tags(synthetic_config["tags"], tags)
+
+    return [("tags", old_tags, synthetic_config["tags"])] if replace_tracker else []
+
+
+def copy_monitor(monitor):
+    """Copies a monitor deep enough for rewrite_monitor to leave the copy untouched (it only replaces the query and
+    the items of the tags list)"""
+    original = dict(monitor)
+
+    if type(original.get("tags")) is list:
+        original["tags"] = list(original["tags"])
+
+    return original
+
+
+def get_synthetic_path(synthetic):
+    """Builds the API path of a synthetic using its type
+
+    :param dict synthetic: synthetic from the synthetics list
+    :return: API path of the synthetic
+    """
+    if synthetic.get("type") not in helpers.SYNTHETIC_PATHS:
+        # Only these types have an update endpoint, the synthetic is reported as an error instead of being guessed
+        raise Exception("Unsupported synthetic type {} for {}.".format(synthetic.get("type"), synthetic["public_id"]))
+
+    return helpers.SYNTHETIC_PATHS[synthetic["type"]].format(synthetic["public_id"])
+
+
+def update_dashboard(dashboard_id, client, tags, modified_at=None, cache=None, plan=None, snapshots=None):
+    """Fetches a single dashboard, replaces its tags and writes it back when running in prod mode (or adds it to
+    the plan in plan mode)
+
+    :param string dashboard_id: id of the dashboard to update
+    :param helpers.DatadogClient client: client used to call the dashboard endpoint
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :param string modified_at: modified_at of the dashboard from the dashboard list
+    :param cache.DefinitionCache cache: local cache of dashboard definitions, or None
+    :param plan.PlanWriter plan: plan the change is added to when running in plan mode
+    :param snapshot.SnapshotRun snapshots: where the original is saved before it is overwritten, or None
+    :return: (JSON path, old value, new value) of the fields where tags were replaced (empty if the dashboard was
+             left untouched)
+    """
+    # Get the config for the dashboard using the id returned in original call, unless the same version is cached
+    with metrics.RUN_STATS.timer("fetch"):
+        raw_config = cache.get(dashboard_id, modified_at) if cache else None
+        if raw_config is None:
+            raw_config = client.get_raw("dashboard/{}".format(dashboard_id))
+
+            if cache:
+                cache.put(dashboard_id, modified_at, raw_config)
+        else:
+            metrics.RUN_STATS.increment("dashboard.cache_hits")
+
+    dashboard_config, changes = rewrite_dashboard(raw_config, tags)
+
+    # Rules that only map tags to what they already are leave the dashboard as it was, so nothing is written
+    if changes:
+        # Update existing dashboard with new config
+        write_back(client, "dashboard", dashboard_id, "dashboard/{}".format(dashboard_id), dashboard_config,
+                   modified_at, plan, snapshots, raw_config)
+
+    return changes
+
+
+def update_dashboards(client, tags, config_dashboard_list=None, concurrency=DEFAULT_CONCURRENCY, journal=None,
+                      cache=None, plan=None, snapshots=None):
     """Updates all the dashboard in a DD account based on tags provided
 
-    :param string dd_api_key: Datadog api key used to authenticate to dashboard endpoint
-    :param string dd_app_key: Datadog app key used to authenticate to dashboard endpoint
-    :param boolean eu_customer: True if customer is in EU, else false
+    Dashboards are fetched, rewritten and written back by a bounded pool of workers so the API calls for different
+    dashboards overlap. A failing dashboard is reported at the end of the run instead of aborting the others.
+
+    :param helpers.DatadogClient client: client used to call the dashboard endpoint
     :param dict tags: contains key/value of the old tags/new tags to replace
     :param list config_dashboard_list: contains dashboard ids to only target (targets all if None)
-    :return:
+    :param int concurrency: max number of dashboards processed at the same time
+    :param journal.Journal journal: progress journal used to skip dashboards handled by a previous run
+    :param cache.DefinitionCache cache: local cache of dashboard definitions, or None
+    :param plan.PlanWriter plan: plan changes are added to when running in plan mode
+    :param snapshot.SnapshotRun snapshots: where originals are saved before they are overwritten, or None
+    :return: results of the run (see new_results)
     """
-    dashboards_list = helpers.call_api("dashboard", dd_api_key, dd_app_key, eu_customer)["dashboards"]
+    dashboards_list = client.call("dashboard")["dashboards"]
 
-    TEST_MODE_SET = set()
+    results = new_results()
 
-    for dashboard in dashboards_list:
-        dashboard_id = dashboard["id"]
-        if config_dashboard_list and dashboard_id not in config_dashboard_list:
-            continue
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
 
-        final_replace_tracker = False
+        for dashboard in dashboards_list:
+            dashboard_id = dashboard["id"]
+            if config_dashboard_list and dashboard_id not in config_dashboard_list:
+                continue
 
-        # Get the config for the dashboard using the id returned in original call
-        dashboard_config = helpers.call_api(
-            "dashboard/{}".format(dashboard_id),
-            dd_api_key,
-            dd_app_key,
-            eu_customer
-        )
-        widgets = dashboard_config["widgets"]
-
-        for widget_counter, widget in enumerate(widgets):
-            # Response: {'definition': {'requests': [{'q':...}] OR [{'q':...}, {'q':...}, etc...] }}
-            if widget["definition"].get("requests"):
-                requests_object = widget["definition"].get("requests")
-
-                for query_counter, query in enumerate(requests_object):
-                    # Ignore the following queries: logs, apm, network, and rum
-                    if ("log_query" in query) or ("apm_query" in query) \
-                            or ("rum_query" in query) or ("network_query" in query):
-                        continue
-
-                    metric_query = helpers.get_metric_query(query, requests_object)
-                    new_metric_query, replace_tracker = helpers.find_and_replace_tags(metric_query, tags)
-
-                    # Update tracker value if it hasn't already been updated
-                    if replace_tracker and not final_replace_tracker:
-                        final_replace_tracker = True
-
-                    requests_object = helpers.build_new_request(new_metric_query, query,
-                                                                requests_object, query_counter)
-
-                    # TODO: Handle 'metadata':[{...,'expression': "<query>" ]}
-                widgets[widget_counter]["definition"]["requests"] = requests_object
-
-            # Response: {'definition': {'widgets': [{'definition':..., 'requests': [{'q':...}] }] }}
-            elif widget["definition"].get("widgets"):
-                definitions = widget["definition"].get("widgets")
-
-                for definition_counter, definition in enumerate(definitions):
-                    # Check if widget definition has a request in it
-                    if definition["definition"].get("requests"):
-                        requests_object = definition["definition"].get("requests")
-
-                        for query_counter, query in enumerate(requests_object):
-                            # Ignore the following queries: logs, apm, network, and rum
-                            if ("log_query" in query) or ("apm_query" in query) \
-                                    or ("rum_query" in query) or ("network_query" in query):
-                                continue
-                            metric_query = helpers.get_metric_query(query, requests_object)
-                            new_metric_query, replace_tracker = helpers.find_and_replace_tags(metric_query, tags)
-                            requests_object = helpers.build_new_request(new_metric_query, query,
-                                                                        requests_object, query_counter)
-
-                            if replace_tracker and not final_replace_tracker:
-                                final_replace_tracker = True
-
-                        widgets[widget_counter]["definition"]["widgets"][definition_counter]["definition"]["requests"] = requests_object
-            # Response: {'definition': {'query':..., }}
-            elif widget["definition"].get("query"):
-                widgets[widget_counter]["definition"]["query"], replace_tracker = \
-                    helpers.find_and_replace_tags(widget["definition"].get("query"), tags)
-
-                if replace_tracker and not final_replace_tracker:
-                    final_replace_tracker = True
-
-            # Response: {'definition': {'filters':..., }}
-            elif widget["definition"].get("filters"):
-                widgets[widget_counter]["definition"]["filters"], replace_tracker = \
-                    helpers.find_and_replace_tags(widget["definition"].get("filters"), tags)
-
-                if replace_tracker and not final_replace_tracker:
-                    final_replace_tracker = True
-
-            elif widget["definition"].get("type") in UNSUPPORTED_TYPES:
-                # Unsupported Query
-                pass
-            else:
-                # print("Unparsed calls: ", widget)
-                pass
-
-        # Update dashboard config's widgets
-        dashboard_config["widgets"] = widgets
-
-        if final_replace_tracker:
-            if RUN_MODE == "prod":
-                # Clean up JSON body
-                dashboard_config = helpers.cleanup_dashboard_json(dashboard_config)
-
-                # Update existing dashboard with new config
-                helpers.call_api(
-                    "dashboard/{}".format(dashboard_id),
-                    dd_api_key,
-                    dd_app_key,
-                    eu_customer,
-                    "PUT",
-                    dashboard_config
-                )
-            elif RUN_MODE == "test":
-                TEST_MODE_SET.add(dashboard_id)
-        else:
-            pass
+            if journal and journal.is_done("dashboard", dashboard_id, dashboard.get("modified_at")):
+                results["skipped"] += 1
+                continue
+
+            future = executor.submit(update_dashboard, dashboard_id, client, tags, dashboard.get("modified_at"),
+                                     cache, plan, snapshots)
+            futures[future] = dashboard
+
+        for future in as_completed(futures):
+            dashboard = futures[future]
+            error = future.exception()
+            collect_outcome(results, journal, "dashboard", dashboard["id"], dashboard.get("modified_at"),
+                            None if error else future.result(), error)
+
+    return results
+
+
+def update_monitor(monitor, client, tags, plan=None, snapshots=None):
+    """Replaces the tags of a single monitor from the monitor list and writes it back when running in prod mode (or
+    adds it to the plan in plan mode)
+
+    :param dict monitor: monitor from the monitor list (updated in place)
+    :param helpers.DatadogClient client: client used to call the monitor endpoint
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :param plan.PlanWriter plan: plan the change is added to when running in plan mode
+    :param snapshot.SnapshotRun snapshots: where the original is saved before it is overwritten, or None
+    :return: list of (field, old value, new value) of the fields that were changed
+    """
+    monitor_id = monitor["id"]
+    original = copy_monitor(monitor) if snapshots is not None else None
+
+    with metrics.RUN_STATS.timer("rewrite"):
+        changes = rewrite_monitor(monitor, tags)
+
+    # Update existing monitor with new config(s)
+    if changes:
+        write_back(client, "monitor", monitor_id, "monitor/{}".format(monitor_id), monitor, monitor.get("modified"),
+                   plan, snapshots, helpers.json_dumps(original) if original is not None else None)
 
-    if RUN_MODE == "test":
-        print("** DASHBOARDS **")
-        print("Script will update {} dashboard(s).".format(len(TEST_MODE_SET)))
-        print(*TEST_MODE_SET, sep=", ")
+    return changes
 
 
-def update_monitors(dd_api_key, dd_app_key, eu_customer, tags, config_monitor_list=None):
+def update_monitors(client, tags, config_monitor_list=None, journal=None,
+                    page_size=helpers.DEFAULT_MONITOR_PAGE_SIZE, server_filter=False, plan=None, snapshots=None):
     """Updates all the monitors in a DD account based on tags provided
 
-    :param string dd_api_key: Datadog api key used to authenticate to monitor endpoint
-    :param string dd_app_key: Datadog app key used to authenticate to monitor endpoint
-    :param boolean eu_customer: True if customer is in EU, else false
-    :return:
+    :param helpers.DatadogClient client: client used to call the monitor endpoint
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :param list config_monitor_list: contains monitor ids to only target (targets all if None)
+    :param journal.Journal journal: progress journal used to skip monitors handled by a previous run
+    :param int page_size: number of monitors retrieved per page
+    :param boolean server_filter: True to only ask the API for monitors tagged with or scoped to an old tag
+    :param plan.PlanWriter plan: plan changes are added to when running in plan mode
+    :param snapshot.SnapshotRun snapshots: where originals are saved before they are overwritten, or None
+    :return: results of the run (see new_results)
     """
-    monitors_list = helpers.call_api("monitor", dd_api_key, dd_app_key, eu_customer)
+    # Monitors are streamed page by page rather than loaded all at once
+    if server_filter:
+        monitors_list = helpers.iter_matching_monitors(client, helpers.compile_tags(tags).tags, page_size)
+    else:
+        monitors_list = helpers.iter_monitors(client, page_size, prefilter=helpers.compile_tags(tags))
 
-    TEST_MODE_SET = set()
+    results = new_results()
 
     for monitor in monitors_list:
         monitor_id = monitor["id"]
 
-        final_replace_tracker = False
-
         # If monitor list is specified only continue with loop if ID is present in the list
         if config_monitor_list and monitor_id not in config_monitor_list:
             continue
 
-        # Grab the query from monitor response and replace accordingly
-        monitor_query = monitor["query"]
-        if monitor_query:
-            monitor["query"], replace_tracker = helpers.find_and_replace_tags(monitor_query, tags)
-
-            if replace_tracker and not final_replace_tracker:
-                final_replace_tracker = True
-
-        # Grab the tags from monitor response and replace accordingly
-        monitor_tags = monitor["tags"]
-        if monitor_tags:
-            monitor["tags"], replace_tracker = helpers.find_and_replace_tags(monitor_tags, tags)
-
-            if replace_tracker and not final_replace_tracker:
-                final_replace_tracker = True
-
-        # Update existing monitor with new config(s)
-        if final_replace_tracker:
-            if RUN_MODE == "prod":
-                # Clean up JSON body
-                monitor = helpers.cleanup_monitor_json(monitor)
-                helpers.call_api(
-                    "monitor/{}".format(monitor_id),
-                    dd_api_key,
-                    dd_app_key,
-                    eu_customer,
-                    "PUT",
-                    monitor
-                )
-            elif RUN_MODE == "test":
-                TEST_MODE_SET.add(monitor_id)
-        else:
-            pass
+        modified_at = monitor.get("modified")
+        if journal and journal.is_done("monitor", monitor_id, modified_at):
+            results["skipped"] += 1
+            continue
+
+        # A failing monitor is reported at the end of the run instead of aborting the others
+        try:
+            changes = update_monitor(monitor, client, tags, plan, snapshots)
+        except Exception as e:
+            collect_outcome(results, journal, "monitor", monitor_id, modified_at, error=e)
+            continue
+
+        collect_outcome(results, journal, "monitor", monitor_id, modified_at, changes)
+
+    return results
+
+
+def update_synthetic(synthetic, client, tags, plan=None, snapshots=None):
+    """Fetches, rewrites and writes back a single synthetic already known to carry an old tag
+
+    :param dict synthetic: synthetic from the synthetics list
+    :param helpers.DatadogClient client: client used to call the synthetics endpoint
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :param plan.PlanWriter plan: plan the change is added to when running in plan mode
+    :param snapshot.SnapshotRun snapshots: where the original is saved before it is overwritten, or None
+    :return: list of (field, old value, new value) of the fields that were changed
+    """
+    path = get_synthetic_path(synthetic)
+
+    # Get entire config for the synthetic
+    with metrics.RUN_STATS.timer("fetch"):
+        raw_config = client.get_raw(path)
+
+    with metrics.RUN_STATS.timer("decode"):
+        synthetic_config = helpers.json_loads(raw_config)
 
+    with metrics.RUN_STATS.timer("rewrite"):
+        changes = rewrite_synthetic(synthetic_config, tags)
 
-    if RUN_MODE == "test":
-        print("** MONITORS **")
-        print("Script will update {} monitor(s).".format(len(TEST_MODE_SET)))
-        print(*TEST_MODE_SET, sep=", ")
+    if changes:
+        write_back(client, "synthetic", synthetic["public_id"], path, synthetic_config, synthetic.get("modified_at"),
+                   plan, snapshots, raw_config)
 
-def update_synthetics(dd_api_key, dd_app_key, eu_customer, tags, config_synthetic_list=None):
+    return changes
+
+
+def update_synthetics(client, tags, config_synthetic_list=None, journal=None, plan=None, snapshots=None):
     """Updates all the synthetics in a DD account based on tags provided
 
-    :param string dd_api_key: Datadog api key used to authenticate to synthetics endpoint
-    :param string dd_app_key: Datadog app key used to authenticate to synthetics endpoint
-    :param boolean eu_customer: True if customer is in EU, else false
-    :return:
+    Only the tags of a synthetic are replaced, so which synthetics need updating is decided from the synthetics list
+    and the full config is only fetched for those.
+
+    :param helpers.DatadogClient client: client used to call the synthetics endpoint
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :param list config_synthetic_list: contains synthetic ids to only target (targets all if None)
+    :param journal.Journal journal: progress journal used to skip synthetics handled by a previous run
+    :param plan.PlanWriter plan: plan changes are added to when running in plan mode
+    :param snapshot.SnapshotRun snapshots: where originals are saved before they are overwritten, or None
+    :return: results of the run (see new_results)
     """
-    synthetics_list = helpers.call_api("synthetics/tests", dd_api_key, dd_app_key, eu_customer)["tests"]
+    synthetics_list = client.call("synthetics/tests")["tests"]
 
-    TEST_MODE_SET = set()
+    results = new_results()
 
     for synthetic in synthetics_list:
         synthetic_id = synthetic["public_id"]
@@ -224,57 +543,596 @@ def update_synthetics(dd_api_key, dd_app_key, eu_customer, tags, config_syntheti
         if config_synthetic_list and synthetic_id not in config_synthetic_list:
             continue
 
-        # Grab type to determine API call path
-        synthetic_type = synthetic["type"]
-
-        # Build path using synthetic type
-        if synthetic_type == "browser":
-            path = "synthetics/tests/browser/{}".format(synthetic_id)
-        elif synthetic_type == "api":
-            path = "synthetics/tests/api/{}".format(synthetic_id)
-
-        # Get entire config for the synthetic
-        synthetic_config = helpers.call_api(path, dd_api_key,dd_app_key, eu_customer)
-
-        # Get tags field from synthetic response
-        synthetic_tags = synthetic_config["tags"]
-        synthetic_config["tags"], final_replace_tracker = helpers.find_and_replace_tags(synthetic_tags, tags)
-
-        if final_replace_tracker:
-            if RUN_MODE == "prod":
-                # Cleanup synthetic config
-                synthetic_config = helpers.cleanup_synthetic_json(synthetic_config)
-
-                helpers.call_api(
-                    path,
-                    dd_api_key,
-                    dd_app_key,
-                    eu_customer,
-                    "PUT",
-                    synthetic_config
-                )
-            elif RUN_MODE == "test":
-                TEST_MODE_SET.add(synthetic_id)
+        modified_at = synthetic.get("modified_at")
+        if journal and journal.is_done("synthetic", synthetic_id, modified_at):
+            results["skipped"] += 1
+            continue
+
+        # The list already contains the tags of every synthetic, only fetch the full config of the ones that match
+        if not helpers.compile_tags(tags).matches_list(synthetic.get("tags") or []):
+            record_outcome(journal, "synthetic", synthetic_id, [], modified_at)
+            continue
+
+        metrics.RUN_STATS.increment("synthetic.matched")
+
+        # A failing synthetic is reported at the end of the run instead of aborting the others
+        try:
+            changes = update_synthetic(synthetic, client, tags, plan, snapshots)
+        except Exception as e:
+            collect_outcome(results, journal, "synthetic", synthetic_id, modified_at, error=e)
+            continue
+
+        collect_outcome(results, journal, "synthetic", synthetic_id, modified_at, changes)
+
+    return results
+
+
+def find_host_tags(tag_hosts, tags, config_host_list=None):
+    """Rebuilds the tags of every host carrying an old tag from the tag -> hosts mapping of the tags endpoint
+
+    :param dict tag_hosts: tag -> names of the hosts carrying it
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :param list config_host_list: contains host names to only target (targets all if None)
+    :return: dict of host name -> tags of the host, for every targeted host carrying an old tag
+    """
+    matcher = helpers.compile_tags(tags)
+    host_names = set()
+
+    for tag, tag_host_names in tag_hosts.items():
+        if matcher.matches_list([tag]):
+            host_names.update(tag_host_names)
+
+    if config_host_list:
+        host_names &= set(config_host_list)
+
+    host_tags = {host_name: [] for host_name in sorted(host_names)}
+
+    if host_tags:
+        for tag, tag_host_names in tag_hosts.items():
+            for host_name in tag_host_names:
+                if host_name in host_tags:
+                    host_tags[host_name].append(tag)
+
+    return host_tags
+
+
+def rewrite_host_tags(host_tags, tags):
+    """Replaces the tags of a host
+
+    :param list host_tags: current tags of the host
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :return: tuple of the new tags of the host and the list of (field, old value, new value) that were changed
+    """
+    new_tags, replace_tracker = helpers.find_and_replace_tags(list(host_tags), tags)
+
+    if not replace_tracker:
+        return host_tags, []
+
+    # Two old tags can map to the same new tag, or to a tag the host already has
+    new_tags = list(dict.fromkeys(new_tags))
+
+    return new_tags, [("tags", host_tags, new_tags)]
+
+
+def update_host(host_name, host_tags, client, tags, plan=None, snapshots=None):
+    """Replaces the tags of a single host and writes them back when running in prod mode (or adds them to the plan in
+    plan mode)
+
+    :param string host_name: name of the host
+    :param list host_tags: current tags of the host
+    :param helpers.DatadogClient client: client used to call the tags endpoint
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :param plan.PlanWriter plan: plan the change is added to when running in plan mode
+    :param snapshot.SnapshotRun snapshots: where the original is saved before it is overwritten, or None
+    :return: list of (field, old value, new value) of the fields that were changed
+    """
+    with metrics.RUN_STATS.timer("rewrite"):
+        new_tags, changes = rewrite_host_tags(host_tags, tags)
+
+    if changes:
+        original = helpers.json_dumps({"host": host_name, "tags": host_tags}) if snapshots is not None else None
+        write_back(client, "host", host_name, helpers.host_tags_path(host_name), {"host": host_name, "tags": new_tags},
+                   helpers.host_tags_version(host_tags), plan, snapshots, original)
+
+    return changes
+
+
+def update_hosts(client, tags, config_host_list=None, concurrency=DEFAULT_CONCURRENCY, journal=None, plan=None,
+                 snapshots=None):
+    """Updates the user tags of all the hosts in a DD account based on tags provided
+
+    A single call to the tags endpoint returns every user tag along with the hosts carrying it, so the current tags
+    of the hosts to update are known without fetching any host. Only hosts whose tags change are written, by a
+    bounded pool of workers.
+
+    :param helpers.DatadogClient client: client used to call the tags endpoint
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :param list config_host_list: contains host names to only target (targets all if None)
+    :param int concurrency: max number of hosts written at the same time
+    :param journal.Journal journal: progress journal used to skip hosts handled by a previous run
+    :param plan.PlanWriter plan: plan changes are added to when running in plan mode
+    :param snapshot.SnapshotRun snapshots: where originals are saved before they are overwritten, or None
+    :return: results of the run (see new_results)
+    """
+    with metrics.RUN_STATS.timer("fetch"):
+        tag_hosts = client.call("tags/hosts", params={"source": helpers.HOST_TAGS_SOURCE})["tags"]
+
+    # The mapping of every tag of the account is not needed once the hosts to update are known
+    host_tags = find_host_tags(tag_hosts, tags, config_host_list)
+    del tag_hosts
+
+    results = new_results()
+
+    def targets():
+        for host_name, current_tags in host_tags.items():
+            metrics.RUN_STATS.increment("host.matched")
+
+            modified_at = helpers.host_tags_version(current_tags)
+            if journal and journal.is_done("host", host_name, modified_at):
+                results["skipped"] += 1
+                continue
+
+            yield host_name, current_tags, modified_at
+
+    # Only a bounded number of hosts is queued at a time, accounts can have tens of thousands of them
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = helpers.iter_bounded(
+            executor,
+            targets(),
+            lambda target: update_host(target[0], target[1], client, tags, plan, snapshots),
+            concurrency * 2
+        )
+
+        for (host_name, _, modified_at), changes, error in outcomes:
+            collect_outcome(results, journal, "host", host_name, modified_at, changes, error)
+
+    return results
+
+
+async def update_dashboard_async(dashboard_id, client, tags, modified_at=None, cache=None, plan=None,
+                                 snapshots=None):
+    """asyncio counterpart of update_dashboard
+
+    :param helpers.AsyncDatadogClient client: client used to call the dashboard endpoint
+    :return: (JSON path, old value, new value) of the fields where tags were replaced
+    """
+    with metrics.RUN_STATS.timer("fetch"):
+        raw_config = cache.get(dashboard_id, modified_at) if cache else None
+        if raw_config is None:
+            raw_config = await client.get_raw("dashboard/{}".format(dashboard_id))
+
+            if cache:
+                cache.put(dashboard_id, modified_at, raw_config)
         else:
-            pass
+            metrics.RUN_STATS.increment("dashboard.cache_hits")
 
-    if RUN_MODE == "test":
-        print("** SYNTHETICS **")
-        print("Script will update {} synthetic(s).".format(len(TEST_MODE_SET)))
-        print(*TEST_MODE_SET, sep=", ")
+    dashboard_config, changes = rewrite_dashboard(raw_config, tags)
 
+    if changes:
+        await write_back_async(client, "dashboard", dashboard_id, "dashboard/{}".format(dashboard_id),
+                               dashboard_config, modified_at, plan, snapshots, raw_config)
 
-def main():
-    if "DD_API_KEY" in os.environ and "DD_APP_KEY" in os.environ:
-        dd_api_key = os.environ.get('DD_API_KEY')
-        dd_app_key = os.environ.get('DD_APP_KEY')
+    return changes
+
+
+async def update_dashboards_async(client, tags, config_dashboard_list=None, journal=None, cache=None, plan=None,
+                                  snapshots=None, concurrency=DEFAULT_CONCURRENCY):
+    """asyncio counterpart of update_dashboards, at most concurrency dashboards are processed at the same time (see
+    helpers.iter_bounded_async)
+
+    :param helpers.AsyncDatadogClient client: client used to call the dashboard endpoint
+    :return: results of the run (see new_results)
+    """
+    dashboards_list = (await client.call("dashboard"))["dashboards"]
+
+    results = new_results()
+
+    def targets():
+        for dashboard in dashboards_list:
+            dashboard_id = dashboard["id"]
+            if config_dashboard_list and dashboard_id not in config_dashboard_list:
+                continue
+
+            if journal and journal.is_done("dashboard", dashboard_id, dashboard.get("modified_at")):
+                results["skipped"] += 1
+                continue
+
+            yield dashboard
+
+    outcomes = helpers.iter_bounded_async(
+        targets(),
+        lambda dashboard: update_dashboard_async(dashboard["id"], client, tags, dashboard.get("modified_at"), cache,
+                                                 plan, snapshots),
+        concurrency
+    )
+
+    async for dashboard, changes, error in outcomes:
+        collect_outcome(results, journal, "dashboard", dashboard["id"], dashboard.get("modified_at"), changes, error)
+
+    return results
+
+
+async def update_monitor_async(monitor, client, tags, plan=None, snapshots=None):
+    """asyncio counterpart of update_monitor
+
+    :param helpers.AsyncDatadogClient client: client used to call the monitor endpoint
+    :return: list of (field, old value, new value) of the fields that were changed
+    """
+    monitor_id = monitor["id"]
+    original = copy_monitor(monitor) if snapshots is not None else None
+
+    with metrics.RUN_STATS.timer("rewrite"):
+        changes = rewrite_monitor(monitor, tags)
+
+    if changes:
+        await write_back_async(client, "monitor", monitor_id, "monitor/{}".format(monitor_id), monitor,
+                               monitor.get("modified"), plan, snapshots,
+                               helpers.json_dumps(original) if original is not None else None)
+
+    return changes
+
+
+async def update_monitors_async(client, tags, config_monitor_list=None, journal=None,
+                                page_size=helpers.DEFAULT_MONITOR_PAGE_SIZE, server_filter=False, plan=None,
+                                snapshots=None, concurrency=DEFAULT_CONCURRENCY):
+    """asyncio counterpart of update_monitors, at most concurrency monitor writes run while the next pages are read
+    (see helpers.iter_bounded_async)
+
+    :param helpers.AsyncDatadogClient client: client used to call the monitor endpoint
+    :return: results of the run (see new_results)
+    """
+    if server_filter:
+        monitors_list = helpers.iter_matching_monitors_async(client, helpers.compile_tags(tags).tags, page_size)
     else:
-        raise Exception("Datadog API and APP keys are required. Please provide both via environment variables.")
+        monitors_list = helpers.iter_monitors_async(client, page_size, prefilter=helpers.compile_tags(tags))
+
+    results = new_results()
+
+    async def targets():
+        async for monitor in monitors_list:
+            monitor_id = monitor["id"]
+
+            if config_monitor_list and monitor_id not in config_monitor_list:
+                continue
+
+            modified_at = monitor.get("modified")
+            if journal and journal.is_done("monitor", monitor_id, modified_at):
+                results["skipped"] += 1
+                continue
+
+            # The cleanup before the write removes the id and modified time, keep them for the outcome
+            yield monitor_id, modified_at, monitor
+
+    outcomes = helpers.iter_bounded_async(
+        targets(),
+        lambda target: update_monitor_async(target[2], client, tags, plan, snapshots),
+        concurrency
+    )
+
+    async for (monitor_id, modified_at, _), changes, error in outcomes:
+        collect_outcome(results, journal, "monitor", monitor_id, modified_at, changes, error)
+
+    return results
+
+
+async def update_synthetic_async(synthetic, client, tags, plan=None, snapshots=None):
+    """Fetches, rewrites and writes back a single synthetic already known to carry an old tag
+
+    :param dict synthetic: synthetic from the synthetics list
+    :param helpers.AsyncDatadogClient client: client used to call the synthetics endpoint
+    :return: list of (field, old value, new value) of the fields that were changed
+    """
+    path = get_synthetic_path(synthetic)
+    with metrics.RUN_STATS.timer("fetch"):
+        raw_config = await client.get_raw(path)
+
+    with metrics.RUN_STATS.timer("decode"):
+        synthetic_config = helpers.json_loads(raw_config)
+
+    with metrics.RUN_STATS.timer("rewrite"):
+        changes = rewrite_synthetic(synthetic_config, tags)
+
+    if changes:
+        await write_back_async(client, "synthetic", synthetic["public_id"], path, synthetic_config,
+                               synthetic.get("modified_at"), plan, snapshots, raw_config)
+
+    return changes
+
+
+async def update_synthetics_async(client, tags, config_synthetic_list=None, journal=None, plan=None,
+                                  snapshots=None, concurrency=DEFAULT_CONCURRENCY):
+    """asyncio counterpart of update_synthetics, at most concurrency matching synthetics are fetched and written back
+    at the same time (see helpers.iter_bounded_async)
+
+    :param helpers.AsyncDatadogClient client: client used to call the synthetics endpoint
+    :return: results of the run (see new_results)
+    """
+    synthetics_list = (await client.call("synthetics/tests"))["tests"]
+
+    results = new_results()
+
+    def targets():
+        for synthetic in synthetics_list:
+            synthetic_id = synthetic["public_id"]
+
+            if config_synthetic_list and synthetic_id not in config_synthetic_list:
+                continue
+
+            modified_at = synthetic.get("modified_at")
+            if journal and journal.is_done("synthetic", synthetic_id, modified_at):
+                results["skipped"] += 1
+                continue
+
+            if helpers.compile_tags(tags).matches_list(synthetic.get("tags") or []):
+                metrics.RUN_STATS.increment("synthetic.matched")
+                yield synthetic
+            else:
+                record_outcome(journal, "synthetic", synthetic_id, [], modified_at)
+
+    outcomes = helpers.iter_bounded_async(
+        targets(),
+        lambda synthetic: update_synthetic_async(synthetic, client, tags, plan, snapshots),
+        concurrency
+    )
+
+    async for synthetic, changes, error in outcomes:
+        collect_outcome(results, journal, "synthetic", synthetic["public_id"], synthetic.get("modified_at"), changes,
+                        error)
+
+    return results
 
-    eu_customer = os.environ.get('EU_CUSTOMER', False)
+
+async def update_host_async(host_name, host_tags, client, tags, plan=None, snapshots=None):
+    """asyncio counterpart of update_host
+
+    :param helpers.AsyncDatadogClient client: client used to call the tags endpoint
+    :return: list of (field, old value, new value) of the fields that were changed
+    """
+    with metrics.RUN_STATS.timer("rewrite"):
+        new_tags, changes = rewrite_host_tags(host_tags, tags)
+
+    if changes:
+        original = helpers.json_dumps({"host": host_name, "tags": host_tags}) if snapshots is not None else None
+        await write_back_async(client, "host", host_name, helpers.host_tags_path(host_name),
+                               {"host": host_name, "tags": new_tags}, helpers.host_tags_version(host_tags), plan,
+                               snapshots, original)
+
+    return changes
+
+
+async def update_hosts_async(client, tags, config_host_list=None, journal=None, plan=None, snapshots=None,
+                             concurrency=DEFAULT_CONCURRENCY):
+    """asyncio counterpart of update_hosts, at most concurrency hosts are written at the same time (see
+    helpers.iter_bounded_async)
+
+    :param helpers.AsyncDatadogClient client: client used to call the tags endpoint
+    :return: results of the run (see new_results)
+    """
+    with metrics.RUN_STATS.timer("fetch"):
+        tag_hosts = (await client.call("tags/hosts", params={"source": helpers.HOST_TAGS_SOURCE}))["tags"]
+
+    # The mapping of every tag of the account is not needed once the hosts to update are known
+    host_tags = find_host_tags(tag_hosts, tags, config_host_list)
+    del tag_hosts
+
+    results = new_results()
+
+    def targets():
+        for host_name, current_tags in host_tags.items():
+            metrics.RUN_STATS.increment("host.matched")
+
+            modified_at = helpers.host_tags_version(current_tags)
+            if journal and journal.is_done("host", host_name, modified_at):
+                results["skipped"] += 1
+                continue
+
+            yield host_name, modified_at
+
+    outcomes = helpers.iter_bounded_async(
+        targets(),
+        lambda target: update_host_async(target[0], host_tags[target[0]], client, tags, plan, snapshots),
+        concurrency
+    )
+
+    async for (host_name, modified_at), changes, error in outcomes:
+        collect_outcome(results, journal, "host", host_name, modified_at, changes, error)
+
+    return results
+
+
+def get_targets(json_file, resource_type):
+    """Reads which resources of a type configs.json targets
+
+    :param dict json_file: content of configs.json
+    :param string resource_type: dashboard/monitor/synthetic
+    :return: False if the resource type is ignored, None to target every resource, else the set of ids to target
+    """
+    resource_ids = json_file.get(resource_type + "s")
+
+    # Opt-in resource types are ignored unless they are listed
+    if resource_ids is None and resource_type in OPT_IN_RESOURCE_TYPES:
+        return False
+
+    if resource_ids is not None and len(resource_ids) == 0:
+        return False
+    elif resource_ids and "*" not in resource_ids:
+        return set(resource_ids)
+
+    # If the list is not set or is set to ["*"], target every resource
+    return None
+
+
+def report_ignored(resource_type):
+    if resource_type in OPT_IN_RESOURCE_TYPES:
+        return
+
+    print("Ignoring {0}s due to configs.json empty {0}s list.".format(resource_type))
+
+
+def run_sync(client, tags, targets, concurrency=DEFAULT_CONCURRENCY, journal=None, cache=None, plan=None,
+             monitor_page_size=helpers.DEFAULT_MONITOR_PAGE_SIZE, monitor_server_filter=False, snapshots=None):
+    """Processes dashboards, monitors, synthetics and hosts one resource type after the other
+
+    :param helpers.DatadogClient client: client used to call the API
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :param dict targets: resource type -> targeted ids (see get_targets)
+    :return:
+    """
+    for resource_type in RESOURCE_TYPES:
+        target_ids = targets[resource_type]
+
+        if target_ids is False:
+            report_ignored(resource_type)
+            continue
+
+        if resource_type == "dashboard":
+            results = update_dashboards(client, tags, target_ids, concurrency, journal, cache, plan, snapshots)
+        elif resource_type == "monitor":
+            results = update_monitors(client, tags, target_ids, journal, monitor_page_size, monitor_server_filter,
+                                      plan, snapshots)
+        elif resource_type == "synthetic":
+            results = update_synthetics(client, tags, target_ids, journal, plan, snapshots)
+        else:
+            results = update_hosts(client, tags, target_ids, concurrency, journal, plan, snapshots)
+
+        report(resource_type, results)
+
+
+async def run_async(client, tags, targets, journal=None, cache=None, plan=None,
+                    monitor_page_size=helpers.DEFAULT_MONITOR_PAGE_SIZE, monitor_server_filter=False, snapshots=None):
+    """Processes dashboards, monitors, synthetics and hosts at the same time on one event loop
+
+    All the requests share the concurrency limit of the client. Results are reported once everything is done, in
+    the same order and format as run_sync.
+
+    :param helpers.AsyncDatadogClient client: client used to call the API
+    :param dict tags: contains key/value of the old tags/new tags to replace
+    :param dict targets: resource type -> targeted ids (see get_targets)
+    :return:
+    """
+    coroutines = {}
+
+    async with client:
+        if targets["dashboard"] is not False:
+            coroutines["dashboard"] = update_dashboards_async(client, tags, targets["dashboard"], journal, cache,
+                                                              plan, snapshots, client.concurrency)
+        if targets["monitor"] is not False:
+            coroutines["monitor"] = update_monitors_async(client, tags, targets["monitor"], journal,
+                                                          monitor_page_size, monitor_server_filter, plan, snapshots,
+                                                          client.concurrency)
+        if targets["synthetic"] is not False:
+            coroutines["synthetic"] = update_synthetics_async(client, tags, targets["synthetic"], journal, plan,
+                                                              snapshots, client.concurrency)
+        if targets["host"] is not False:
+            coroutines["host"] = update_hosts_async(client, tags, targets["host"], journal, plan, snapshots,
+                                                    client.concurrency)
+
+        results = dict(zip(coroutines, await asyncio.gather(*coroutines.values())))
+
+    for resource_type in RESOURCE_TYPES:
+        if resource_type in results:
+            report(resource_type, results[resource_type])
+        else:
+            report_ignored(resource_type)
+
+
+def apply_plan(client, plan_file, concurrency, journal=None, snapshots=None):
+    """Pushes the changes of a plan file and reports the outcome
+
+    :param helpers.DatadogClient client: client used to call the API
+    :param string plan_file: path of the plan file written by a plan run
+    :param int concurrency: max number of changes applied at the same time
+    :param journal.Journal journal: progress journal used to skip changes already applied
+    :param snapshot.SnapshotRun snapshots: where originals are saved before they are overwritten, or None
+    :return:
+    """
+    if not os.path.exists(plan_file):
+        raise Exception("Plan file {} not found. Run with RUN_MODE=plan first.".format(plan_file))
+
+    results = replacement_plan.apply_plan(client, plan_file, concurrency, journal, snapshots)
+
+    metrics.RUN_STATS.increment("change.applied", len(results["applied"]))
+    metrics.RUN_STATS.increment("change.conflicts", len(results["conflicts"]))
+    metrics.RUN_STATS.increment("change.skipped", len(results["skipped"]))
+    metrics.RUN_STATS.increment("change.errors", len(results["errors"]))
+
+    print("** APPLY **")
+    print("Applied {} change(s).".format(len(results["applied"])))
+
+    if results["conflicts"]:
+        print("Skipped {} resource(s) modified since the plan was made, run plan again for them:".format(
+            len(results["conflicts"])))
+        print(*("{} {}".format(resource_type, resource_id) for resource_type, resource_id in results["conflicts"]),
+              sep=", ")
+
+    report_skipped("change", len(results["skipped"]))
+    report_errors("change", {"{} {}".format(*key): error for key, error in results["errors"].items()})
+
+
+def report_stats(client, tags=None, stats_tags=None):
+    """Prints the timings and counters of the run, and sends them to DogStatsD if DOGSTATSD_HOST is set
+
+    :param helpers.DatadogClient client: client of the run, used to tag the metrics with the Datadog site
+    :param helpers.TagMatcher tags: compiled tags map of the run, its query cache statistics are added to the stats
+    :param list stats_tags: extra tags added to the DogStatsD metrics
+    :return:
+    """
+    if tags is not None:
+        cache_info = tags.cache_info()
+        metrics.RUN_STATS.increment("query_cache.hits", cache_info["hits"])
+        metrics.RUN_STATS.increment("query_cache.misses", cache_info["misses"])
+        metrics.RUN_STATS.gauge("query_cache.size", cache_info["size"])
+
+    metrics.RUN_STATS.report()
+
+    if os.environ.get('DOGSTATSD_HOST'):
+        metrics.RUN_STATS.send_dogstatsd(
+            os.environ.get('DOGSTATSD_HOST'),
+            int(os.environ.get('DOGSTATSD_PORT', metrics.DEFAULT_DOGSTATSD_PORT)),
+            ["run_mode:" + RUN_MODE, "site:" + client.base_url.split("/")[2]] + list(stats_tags or [])
+        )
+
+
+def run_org(dd_api_key, dd_app_key, eu_customer=False, site=None, configs_file=DEFAULT_CONFIGS_FILE,
+            journal_file=None, plan_file=DEFAULT_PLAN_FILE, dashboard_cache_dir=None, rate_limit=None,
+            stats_tags=None, snapshot_dir=None):
+    """Runs the replacer against a single Datadog org, settings shared by every org are read from the environment
+
+    :param string dd_api_key: Datadog api key used to authenticate to API
+    :param string dd_app_key: Datadog app key used to authenticate to API
+    :param boolean eu_customer: True if customer is in EU, otherwise false
+    :param string site: explicit Datadog site (e.g. us3.datadoghq.com), takes precedence over eu_customer
+    :param string configs_file: path of the configs.json of the org
+    :param string journal_file: path of the progress journal of the org, or None
+    :param string plan_file: path of the plan file written in plan mode and read in apply mode
+    :param string dashboard_cache_dir: folder of the dashboard cache of the org, or None
+    :param float rate_limit: max requests per second sent to the org (no limit if None)
+    :param list stats_tags: extra tags added to the DogStatsD metrics of the run
+    :param string snapshot_dir: folder of the snapshot store originals are saved to before being written, or None
+    :return:
+    """
+    concurrency = int(os.environ.get('CONCURRENCY', DEFAULT_CONCURRENCY))
+
+    # Large request bodies are only compressed if API_GZIP_MIN_KB is set
+    gzip_min_bytes = None
+    if os.environ.get('API_GZIP_MIN_KB'):
+        gzip_min_bytes = int(os.environ.get('API_GZIP_MIN_KB')) * 1024
+
+    # One client (and connection pool) is shared by dashboards, monitors and synthetics
+    client = helpers.DatadogClient(
+        dd_api_key,
+        dd_app_key,
+        eu_customer,
+        site=site,
+        timeout=int(os.environ.get('API_TIMEOUT', helpers.DEFAULT_TIMEOUT)),
+        max_retries=int(os.environ.get('API_MAX_RETRIES', helpers.DEFAULT_MAX_RETRIES)),
+        pool_size=concurrency,
+        rate_limit=rate_limit,
+        gzip_min_bytes=gzip_min_bytes
+    )
 
     # Open JSON file with configs
-    with open('configs.json') as f:
+    with open(configs_file) as f:
         json_file = json.load(f)
 
     try:
@@ -283,36 +1141,287 @@ def main():
     except KeyError as e:
         raise Exception("Tags field is required in the tags json. Please make sure it's specified and run again.")
 
-    # Dashboards
-    dashboards = json_file.get("dashboards")
-    if dashboards is not None and len(dashboards) == 0:
-        print("Ignoring dashboards due to configs.json empty dashboards list.")
-    elif dashboards and "*" not in dashboards:
-        dashboards = set(dashboards)
-        update_dashboards(dd_api_key, dd_app_key, eu_customer, tags, dashboards)
-    else:
-        # If "dashboards" is not set or dashboards is set to ["*"], run function on all dashboards
-        update_dashboards(dd_api_key, dd_app_key, eu_customer, tags)
-
-    # Monitors
-    monitors = json_file.get("monitors")
-    if monitors is not None and len(monitors) == 0:
-        print("Ignoring monitors due to configs.json empty monitors list.")
-    elif monitors and "*" not in monitors:
-        monitors = set(monitors)
-        update_monitors(dd_api_key, dd_app_key, eu_customer, tags, monitors)
+    # Resume from the progress journal of a previous run if one is configured
+    journal = None
+    if journal_file:
+        journal = progress_journal.Journal(journal_file, tags)
+
+    # Dashboard definitions are cached locally between runs if a cache folder is configured
+    dashboard_cache = None
+    if dashboard_cache_dir:
+        dashboard_cache = definition_cache.DefinitionCache(
+            dashboard_cache_dir,
+            int(os.environ.get('DASHBOARD_CACHE_MAX_MB', definition_cache.DEFAULT_MAX_MB)) * 1024 * 1024
+        )
+
+    # Resources are saved as they were before being written so the run can be rolled back with rollback.py
+    snapshots = None
+    if snapshot_dir and RUN_MODE in ("prod", "apply"):
+        snapshots = snapshot_store.SnapshotStore(snapshot_dir).start_run()
+
+    # Apply mode only pushes the changes of an existing plan
+    if RUN_MODE == "apply":
+        apply_plan(client, plan_file, concurrency, journal, snapshots)
+
+        if journal:
+            journal.close()
+
+        if snapshots:
+            close_snapshots(snapshots)
+
+        report_stats(client, stats_tags=stats_tags)
+        return
+
+    plan = replacement_plan.PlanWriter(plan_file) if RUN_MODE == "plan" else None
+
+    # Compile the tags map once so every query is rewritten in a single pass
+    tags = helpers.TagMatcher(tags, int(os.environ.get('QUERY_CACHE_SIZE', helpers.DEFAULT_QUERY_CACHE_SIZE)))
+
+    targets = {resource_type: get_targets(json_file, resource_type) for resource_type in RESOURCE_TYPES}
+    monitor_page_size = int(os.environ.get('MONITOR_PAGE_SIZE', helpers.DEFAULT_MONITOR_PAGE_SIZE))
+    monitor_server_filter = os.environ.get('MONITOR_SERVER_FILTER', False) == "True"
+
+    if monitor_server_filter and tags.pattern_rules:
+        raise Exception("MONITOR_SERVER_FILTER can't be used with wildcard tag rules. Please disable it and run again.")
+
+    if os.environ.get('ASYNC_MODE', False) == "True":
+        # Dashboards, monitors and synthetics interleave on one event loop
+        async_client = helpers.AsyncDatadogClient(
+            dd_api_key,
+            dd_app_key,
+            eu_customer,
+            site=site,
+            timeout=int(os.environ.get('API_TIMEOUT', helpers.DEFAULT_TIMEOUT)),
+            max_retries=int(os.environ.get('API_MAX_RETRIES', helpers.DEFAULT_MAX_RETRIES)),
+            concurrency=concurrency,
+            rate_limit=rate_limit,
+            gzip_min_bytes=gzip_min_bytes
+        )
+        asyncio.run(run_async(async_client, tags, targets, journal, dashboard_cache, plan, monitor_page_size,
+                              monitor_server_filter, snapshots))
     else:
-        update_monitors(dd_api_key, dd_app_key, eu_customer, tags)
-
-    # Synthetics
-    synthetics = json_file.get("synthetics")
-    if synthetics is not None and len(synthetics) == 0:
-        print("Ignoring synthetics due to configs.json empty synthetics list.")
-    elif synthetics and "*" not in synthetics:
-        synthetics = set(synthetics)
-        update_synthetics(dd_api_key, dd_app_key, eu_customer, tags, synthetics)
+        run_sync(client, tags, targets, concurrency, journal, dashboard_cache, plan, monitor_page_size,
+                 monitor_server_filter, snapshots)
+
+    if plan:
+        plan.close()
+        print("Plan written to {}. Run with RUN_MODE=apply to push it.".format(plan_file))
+
+    if journal:
+        journal.close()
+
+    if snapshots:
+        close_snapshots(snapshots)
+
+    report_stats(client, tags, stats_tags)
+
+
+def close_snapshots(snapshots):
+    """Closes the snapshot run of a prod or apply run and tells how to roll it back"""
+    snapshots.close()
+    print("Originals saved to {} as snapshot run {}. Run rollback.py --run {} to restore them.".format(
+        snapshots.store.directory, snapshots.run_id, snapshots.run_id))
+
+
+def get_snapshot_dir():
+    """Folder of the snapshot store, snapshots are disabled if SNAPSHOT_DIR is set to an empty value"""
+    return os.environ.get('SNAPSHOT_DIR', snapshot_store.DEFAULT_SNAPSHOT_DIR) or None
+
+
+def get_rate_limit(value):
+    """Parses a requests per second budget, None (or 0) meaning no limit"""
+    return float(value) if value else None
+
+
+def org_path(path, org_name):
+    """Gives each org its own copy of a file by adding the org name before the extension(s) of the path
+
+    :param string path: path set for a single org run (e.g. replacer_journal.jsonl)
+    :param string org_name: name of the org
+    :return: path for the org (e.g. replacer_journal.child-a.jsonl)
+    """
+    directory, file_name = os.path.split(path)
+    stem, dot, extensions = file_name.partition(".")
+
+    return os.path.join(directory, "{}.{}{}{}".format(stem, org_name, dot, extensions))
+
+
+def load_orgs(orgs_file):
+    """Reads the orgs of a multi-org run
+
+    Every org needs a unique 'name' and its keys, either directly ('dd_api_key'/'dd_app_key') or as the name of the
+    environment variables holding them ('dd_api_key_env'/'dd_app_key_env'). 'site', 'eu_customer', 'configs' and
+    'rate_limit' are optional and default to the settings of a single org run.
+
+    :param string orgs_file: path of the orgs JSON file
+    :return: list of the keyword arguments of run_org for each org, along with its 'name'
+    """
+    with open(orgs_file) as f:
+        orgs = json.load(f).get("orgs")
+
+    if not orgs:
+        raise Exception("No orgs found in {}. Please list them under the orgs key and run again.".format(orgs_file))
+
+    settings = []
+    for org in orgs:
+        name = org.get("name")
+        if not name or name in [org_settings["name"] for org_settings in settings]:
+            raise Exception("Every org in {} needs a unique name. Please fix it and run again.".format(orgs_file))
+
+        dd_api_key = org.get("dd_api_key") or os.environ.get(org.get("dd_api_key_env") or "")
+        dd_app_key = org.get("dd_app_key") or os.environ.get(org.get("dd_app_key_env") or "")
+        if not dd_api_key or not dd_app_key:
+            raise Exception("Datadog API and APP keys are required for org {}. Please provide both.".format(name))
+
+        org_settings = {
+            "name": name,
+            "dd_api_key": dd_api_key,
+            "dd_app_key": dd_app_key,
+            "eu_customer": org.get("eu_customer", os.environ.get('EU_CUSTOMER', False)),
+            "site": org.get("site", os.environ.get('DD_SITE')),
+            "configs_file": org.get("configs", DEFAULT_CONFIGS_FILE),
+            "journal_file": org_path(os.environ['JOURNAL_FILE'], name) if os.environ.get('JOURNAL_FILE') else None,
+            "plan_file": org_path(os.environ.get('PLAN_FILE', DEFAULT_PLAN_FILE), name),
+            "dashboard_cache_dir": None,
+            "rate_limit": get_rate_limit(org.get("rate_limit", os.environ.get('API_RATE_LIMIT'))),
+            "stats_tags": ["org:" + name],
+            "snapshot_dir": None
+        }
+
+        if os.environ.get('DASHBOARD_CACHE_DIR'):
+            org_settings["dashboard_cache_dir"] = os.path.join(os.environ.get('DASHBOARD_CACHE_DIR'), name)
+
+        if get_snapshot_dir():
+            org_settings["snapshot_dir"] = os.path.join(get_snapshot_dir(), name)
+
+        settings.append(org_settings)
+
+    return settings
+
+
+def run_org_worker(org_settings, run_mode):
+    """Runs one org of a multi-org run inside a worker process
+
+    The report of the org is captured instead of printed so the reports of orgs running at the same time don't mix.
+
+    :param dict org_settings: settings of the org (see load_orgs)
+    :param string run_mode: RUN_MODE of the run
+    :return: dict with the org 'name', its report 'output', its run stats 'counters', the 'elapsed' seconds and the
+             'error' that stopped it (None if it completed)
+    """
+    global RUN_MODE, REPORT_DIFF
+    RUN_MODE = run_mode
+    REPORT_DIFF = os.environ.get('REPORT_DIFF', False) == "True"
+
+    # Worker processes can be reused for another org, every org starts with its own stats
+    metrics.RUN_STATS = metrics.RunStats()
+
+    run_org_settings = dict(org_settings)
+    name = run_org_settings.pop("name")
+    output = io.StringIO()
+    error = None
+
+    with contextlib.redirect_stdout(output):
+        try:
+            run_org(**run_org_settings)
+        except Exception as e:
+            error = str(e)
+
+    totals = metrics.RUN_STATS.totals()
+
+    return {
+        "name": name,
+        "output": output.getvalue(),
+        "counters": totals["counters"],
+        "elapsed": totals["elapsed"],
+        "error": error
+    }
+
+
+def report_orgs(outcomes):
+    """Prints one line per org of a multi-org run
+
+    :param list outcomes: what run_org_worker returned for each org
+    :return:
+    """
+    print("** ORGS **")
+
+    for outcome in outcomes:
+        counters = outcome["counters"]
+
+        if RUN_MODE == "apply":
+            summary = "{} change(s) applied, {} conflict(s)".format(counters.get("change.applied", 0),
+                                                                     counters.get("change.conflicts", 0))
+            error_count = counters.get("change.errors", 0)
+        else:
+            summary = ", ".join("{} {}(s)".format(counters.get(resource_type + ".changed", 0), resource_type)
+                                for resource_type in RESOURCE_TYPES)
+            summary += " to update" if RUN_MODE in REPORT_MODES else " updated"
+            summary += ", {} skipped".format(sum(counters.get(resource_type + ".skipped", 0)
+                                                 for resource_type in RESOURCE_TYPES))
+            error_count = sum(counters.get(resource_type + ".errors", 0) for resource_type in RESOURCE_TYPES)
+
+        print("{}: {}, {} error(s), {:.1f}s".format(outcome["name"], summary, error_count, outcome["elapsed"]))
+
+        if outcome["error"]:
+            print("  Stopped: {}".format(outcome["error"]))
+
+
+def run_orgs(orgs_file):
+    """Runs the replacer against every org of an orgs file, each org in its own worker process
+
+    Each org has its own client, rate limit budget, journal, plan file and dashboard cache. The report of each org is
+    printed as soon as it is done, followed by one summary line per org once they all are.
+
+    :param string orgs_file: path of the orgs JSON file
+    :return:
+    """
+    orgs = load_orgs(orgs_file)
+    processes = int(os.environ.get('ORG_PROCESSES', len(orgs)))
+    outcomes = {}
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(run_org_worker, org_settings, RUN_MODE): org_settings["name"]
+                   for org_settings in orgs}
+
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                outcome = future.result()
+            except Exception as e:
+                outcome = {"name": name, "output": "", "counters": {}, "elapsed": 0, "error": str(e)}
+
+            outcomes[name] = outcome
+
+            print("===== {} =====".format(name))
+            print(outcome["output"], end="")
+
+    report_orgs([outcomes[org_settings["name"]] for org_settings in orgs])
+
+
+def main():
+    # Several orgs are processed in parallel when an orgs file is configured
+    if os.environ.get('ORGS_FILE'):
+        run_orgs(os.environ.get('ORGS_FILE'))
+        return
+
+    if "DD_API_KEY" in os.environ and "DD_APP_KEY" in os.environ:
+        dd_api_key = os.environ.get('DD_API_KEY')
+        dd_app_key = os.environ.get('DD_APP_KEY')
     else:
-        update_synthetics(dd_api_key, dd_app_key, eu_customer, tags)
+        raise Exception("Datadog API and APP keys are required. Please provide both via environment variables.")
+
+    run_org(
+        dd_api_key,
+        dd_app_key,
+        os.environ.get('EU_CUSTOMER', False),
+        site=os.environ.get('DD_SITE'),
+        journal_file=os.environ.get('JOURNAL_FILE'),
+        plan_file=os.environ.get('PLAN_FILE', DEFAULT_PLAN_FILE),
+        dashboard_cache_dir=os.environ.get('DASHBOARD_CACHE_DIR'),
+        rate_limit=get_rate_limit(os.environ.get('API_RATE_LIMIT')),
+        snapshot_dir=get_snapshot_dir()
+    )
 
 if __name__ == '__main__':
     # loads environment variables
@@ -320,5 +1429,6 @@ if __name__ == '__main__':
     # Get run mode, if not set defaults to test
     global RUN_MODE
     RUN_MODE = os.environ.get("RUN_MODE", "test")
+    REPORT_DIFF = os.environ.get('REPORT_DIFF', False) == "True"
 
     main()
@@ -0,0 +1,115 @@
+import argparse
+import os
+import helpers
+import replacer
+import snapshot as snapshot_store
+from dotenv import load_dotenv
+
+
+def list_runs(store):
+    """Prints the snapshot runs of a store with the number of resources each one saved"""
+    runs = store.list_runs()
+
+    if not runs:
+        print("No snapshot runs found in {}.".format(store.directory))
+        return
+
+    for run_id in runs:
+        entries = store.read_run(run_id)
+        counts = ", ".join("{} {}(s)".format(sum(1 for entry in entries if entry["type"] == resource_type),
+                                             resource_type) for resource_type in replacer.RESOURCE_TYPES)
+        print("{}: {}".format(run_id, counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restores the dashboards, monitors and synthetics overwritten by a "
+                                                 "prod or apply run of the tag replacer")
+    parser.add_argument("--run", help="snapshot run to roll back (defaults to the latest)")
+    parser.add_argument("--type", action="append", choices=replacer.RESOURCE_TYPES, dest="types",
+                        help="only restore this resource type (can be repeated)")
+    parser.add_argument("--id", action="append", dest="ids", help="only restore this resource id (can be repeated)")
+    parser.add_argument("--list", action="store_true", help="list the snapshot runs and exit")
+    parser.add_argument("--dry-run", action="store_true", help="print what would be restored without restoring it")
+    parser.add_argument("--force", action="store_true",
+                        help="also restore the resources modified after the run, discarding those later changes")
+    parser.add_argument("--snapshot-dir",
+                        default=os.environ.get('SNAPSHOT_DIR') or snapshot_store.DEFAULT_SNAPSHOT_DIR)
+    parser.add_argument("--concurrency", type=int,
+                        default=int(os.environ.get('CONCURRENCY', replacer.DEFAULT_CONCURRENCY)))
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.snapshot_dir):
+        raise Exception("Snapshot folder {} not found. Please set --snapshot-dir and run again.".format(
+            args.snapshot_dir))
+
+    store = snapshot_store.SnapshotStore(args.snapshot_dir)
+
+    if args.list:
+        list_runs(store)
+        return
+
+    run_id = args.run
+    if not run_id:
+        runs = store.list_runs()
+        if not runs:
+            raise Exception("No snapshot runs found in {}. Nothing to roll back.".format(args.snapshot_dir))
+        run_id = runs[-1]
+
+    if args.dry_run:
+        for entry in store.read_run(run_id):
+            if (not args.types or entry["type"] in args.types) and (not args.ids or str(entry["id"]) in args.ids):
+                print("Would restore {} {}".format(entry["type"], entry["id"]))
+        return
+
+    if "DD_API_KEY" in os.environ and "DD_APP_KEY" in os.environ:
+        dd_api_key = os.environ.get('DD_API_KEY')
+        dd_app_key = os.environ.get('DD_APP_KEY')
+    else:
+        raise Exception("Datadog API and APP keys are required. Please provide both via environment variables.")
+
+    client = helpers.DatadogClient(
+        dd_api_key,
+        dd_app_key,
+        os.environ.get('EU_CUSTOMER', False),
+        site=os.environ.get('DD_SITE'),
+        timeout=int(os.environ.get('API_TIMEOUT', helpers.DEFAULT_TIMEOUT)),
+        max_retries=int(os.environ.get('API_MAX_RETRIES', helpers.DEFAULT_MAX_RETRIES)),
+        pool_size=args.concurrency,
+        rate_limit=replacer.get_rate_limit(os.environ.get('API_RATE_LIMIT'))
+    )
+
+    # The resources are saved as they are before being restored, so the rollback can be rolled back too
+    snapshots = store.start_run()
+
+    try:
+        results = snapshot_store.restore_run(client, store, run_id, replacer.CLEANUP_FUNCTIONS, args.types, args.ids,
+                                             args.concurrency, snapshots, args.force)
+    finally:
+        replacer.close_snapshots(snapshots)
+
+    print("Restored {} resource(s) from snapshot run {}".format(len(results["restored"]), run_id))
+
+    if results["unchanged"]:
+        print("{} resource(s) were not written by the run, nothing to restore.".format(len(results["unchanged"])))
+
+    if results["conflicts"]:
+        print("Skipped {} resource(s) modified after the run, run again with --force to restore them anyway:".format(
+            len(results["conflicts"])))
+        print(*("{} {}".format(resource_type, resource_id) for resource_type, resource_id in results["conflicts"]),
+              sep=", ")
+
+    for resource_type in replacer.RESOURCE_TYPES:
+        replacer.report_errors(resource_type, {resource_id: error
+                                               for (error_type, resource_id), error in results["errors"].items()
+                                               if error_type == resource_type})
+
+    if os.environ.get('JOURNAL_FILE'):
+        print("Delete {} before running the replacer again, or restored resources will be skipped.".format(
+            os.environ.get('JOURNAL_FILE')))
+
+
+if __name__ == '__main__':
+    # loads environment variables
+    load_dotenv()
+
+    main()
@@ -0,0 +1,246 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import helpers
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULT_SNAPSHOT_DIR = "replacer_snapshots"
+
+# Outcomes of restoring a single resource
+RESTORED = "restored"
+CONFLICT = "conflict"
+UNCHANGED = "unchanged"
+
+
+class SnapshotStore:
+    """Local store of the resources as they were before a run wrote to them
+
+    Bodies are stored gzip compressed under the sha256 of their content, so a body seen in several runs (or by
+    several resources) is only stored once. Each run has a manifest listing, for every resource it wrote, the type,
+    id, API path, modified_at and hash of the body it replaced, followed once the write went through by the version
+    the run wrote (see helpers.resource_version):
+
+        <directory>/objects/ab/abcdef....json.gz
+        <directory>/runs/20240101-120000.jsonl
+    """
+
+    def __init__(self, directory):
+        """
+        :param string directory: folder of the store (created if it doesn't exist)
+        """
+        self.directory = directory
+        self.objects_directory = os.path.join(directory, "objects")
+        self.runs_directory = os.path.join(directory, "runs")
+
+        os.makedirs(self.objects_directory, exist_ok=True)
+        os.makedirs(self.runs_directory, exist_ok=True)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_directory, digest[:2], digest + ".json.gz")
+
+    def put_object(self, raw):
+        """Stores a body unless the same content is already stored
+
+        :param bytes raw: JSON bytes of the body
+        :return: hash the body is stored under
+        """
+        digest = hashlib.sha256(raw).hexdigest()
+        path = self._object_path(digest)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+            with gzip.open(temp_path, "wb", compresslevel=6) as object_file:
+                object_file.write(raw)
+
+            os.replace(temp_path, path)
+
+        return digest
+
+    def get_object(self, digest):
+        """Reads a stored body
+
+        :param string digest: hash returned by put_object
+        :return: JSON bytes of the body
+        """
+        with gzip.open(self._object_path(digest), "rb") as object_file:
+            return object_file.read()
+
+    def start_run(self):
+        """Starts the manifest of a new run
+
+        :return: SnapshotRun the originals of the run are saved through
+        """
+        run_id = time.strftime("%Y%m%d-%H%M%S")
+        suffix = 1
+
+        while os.path.exists(os.path.join(self.runs_directory, run_id + ".jsonl")):
+            suffix += 1
+            run_id = "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), suffix)
+
+        return SnapshotRun(self, run_id)
+
+    def list_runs(self):
+        """Ids of the runs in the store, oldest first"""
+        return sorted(name[:-len(".jsonl")] for name in os.listdir(self.runs_directory) if name.endswith(".jsonl"))
+
+    def read_run(self, run_id):
+        """Reads the manifest of a run
+
+        :param string run_id: id of the run
+        :return: list of manifest entries (dicts with 'type', 'id', 'path', 'modified_at' and 'hash', and the
+                 'written' version if the write went through)
+        """
+        path = os.path.join(self.runs_directory, run_id + ".jsonl")
+
+        if not os.path.exists(path):
+            raise Exception("Snapshot run {} not found in {}.".format(run_id, self.directory))
+
+        entries = {}
+
+        with open(path) as manifest_file:
+            for line in manifest_file:
+                if not line.strip():
+                    continue
+
+                entry = json.loads(line)
+                key = (entry["type"], entry["id"])
+
+                if "hash" in entry:
+                    entries[key] = entry
+                elif key in entries:
+                    entries[key]["written"] = entry["written"]
+
+        return list(entries.values())
+
+
+class SnapshotRun:
+    """Manifest of a single run, safe to use from several threads"""
+
+    def __init__(self, store, run_id):
+        self.store = store
+        self.run_id = run_id
+        self.lock = threading.Lock()
+        self.manifest_file = open(os.path.join(store.runs_directory, run_id + ".jsonl"), "a")
+
+    def save(self, resource_type, resource_id, path, raw, modified_at=None):
+        """Saves the original of a resource about to be written
+
+        :param string resource_type: dashboard/monitor/synthetic
+        :param resource_id: id of the resource
+        :param string path: API path of the resource
+        :param bytes raw: JSON bytes of the resource before it is written
+        :param string modified_at: last modification time of the original
+        :return:
+        """
+        entry = {
+            "type": resource_type,
+            "id": resource_id,
+            "path": path,
+            "modified_at": modified_at,
+            "hash": self.store.put_object(raw)
+        }
+
+        self._append(entry)
+
+    def written(self, resource_type, resource_id, raw):
+        """Records the version of a resource the run wrote, so a rollback can tell whether it changed since
+
+        :param string resource_type: dashboard/monitor/synthetic/host
+        :param resource_id: id of the resource
+        :param bytes raw: JSON bytes of the response to the PUT of the resource
+        :return:
+        """
+        self._append({
+            "type": resource_type,
+            "id": resource_id,
+            "written": helpers.resource_version(resource_type, helpers.json_loads(raw))
+        })
+
+    def _append(self, entry):
+        with self.lock:
+            # Flushed right away so an original is on disk before the resource is written
+            self.manifest_file.write(json.dumps(entry) + "\n")
+            self.manifest_file.flush()
+
+    def close(self):
+        self.manifest_file.close()
+
+
+def restore_entry(client, store, entry, cleanup_functions, snapshots=None, force=False):
+    """PUTs back the original of a resource unless it was modified after the run wrote it
+
+    :param helpers.DatadogClient client: client used to call the API
+    :param SnapshotStore store: store the run was saved to
+    :param dict entry: manifest entry of the resource
+    :param dict cleanup_functions: resource type -> function removing the read-only fields of a config
+    :param SnapshotRun snapshots: where the current resource is saved before it is overwritten, or None
+    :param boolean force: restore the original even if the resource was modified after the run
+    :return: RESTORED, CONFLICT if the resource was modified after the run wrote it, or UNCHANGED if it is still the
+             original (the write of the run didn't go through)
+    """
+    current_raw = client.get_raw(entry["path"])
+    current_version = helpers.resource_version(entry["type"], helpers.json_loads(current_raw))
+
+    # For hosts the version is the fingerprint of their tags, they have no modification time
+    if not force and current_version != entry.get("written"):
+        return UNCHANGED if current_version == entry["modified_at"] else CONFLICT
+
+    if snapshots is not None:
+        snapshots.save(entry["type"], entry["id"], entry["path"], current_raw, current_version)
+
+    config = cleanup_functions[entry["type"]](helpers.json_loads(store.get_object(entry["hash"])))
+    response = client.request(entry["path"], "PUT", config)
+
+    if snapshots is not None:
+        snapshots.written(entry["type"], entry["id"], response.content)
+
+    return RESTORED
+
+
+def restore_run(client, store, run_id, cleanup_functions, resource_types=None, resource_ids=None, concurrency=8,
+                snapshots=None, force=False):
+    """PUTs back the originals saved by a run, skipping the resources modified after the run wrote them
+
+    :param helpers.DatadogClient client: client used to call the API
+    :param SnapshotStore store: store the run was saved to
+    :param string run_id: id of the run to roll back
+    :param dict cleanup_functions: resource type -> function removing the read-only fields of a config
+    :param resource_types: only restore these resource types (all if None)
+    :param resource_ids: only restore these resource ids (all if None)
+    :param int concurrency: max number of resources restored at the same time
+    :param SnapshotRun snapshots: run of the store the current resources are saved to before being restored, so the
+                                  rollback can be rolled back too, or None
+    :param boolean force: restore the resources modified after the run too
+    :return: dict with the 'restored', 'conflicts' and 'unchanged' (type, id) lists and the 'errors' dict
+    """
+    entries = [
+        entry for entry in store.read_run(run_id)
+        if (not resource_types or entry["type"] in resource_types)
+        and (not resource_ids or str(entry["id"]) in resource_ids)
+    ]
+
+    results = {"restored": [], "conflicts": [], "unchanged": [], "errors": {}}
+    outcome_lists = {RESTORED: "restored", CONFLICT: "conflicts", UNCHANGED: "unchanged"}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(restore_entry, client, store, entry, cleanup_functions, snapshots, force): entry
+            for entry in entries
+        }
+
+        for future in as_completed(futures):
+            key = (futures[future]["type"], futures[future]["id"])
+            try:
+                outcome = future.result()
+            except Exception as e:
+                results["errors"][key] = e
+                continue
+
+            results[outcome_lists[outcome]].append(key)
+
+    return results